@@ -0,0 +1,397 @@
+"""Parallel file copying.
+
+Files are copied on a bounded pool of worker threads. When the source and
+the target are on the same filesystem, a reflink (FICLONE) or
+copy_file_range() is tried first, so that no data has to pass through user
+space. Otherwise the file is streamed with a large buffer.
+
+In sync mode a manifest of everything copied is kept, so that a re-run only
+transfers new or changed files and removes the ones gone from the source.
+"""
+import os
+import stat
+import shutil
+import fcntl
+import errno
+import threading
+import json
+import hashlib
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor
+
+from _utils import write_file
+
+
+DEFAULT_WORKERS = 8
+BUFFER_SIZE = 1024 * 1024
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+# errors meaning that the fast path is not supported here
+_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+        errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF, errno.EPERM}
+
+
+class CopyStats:
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.unchanged = 0
+        self.removed = 0
+        self.start = monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, size):
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+
+    def skip(self):
+        with self._lock:
+            self.unchanged += 1
+
+    def remove(self):
+        with self._lock:
+            self.removed += 1
+
+    def summary(self):
+        elapsed = max(monotonic() - self.start, 1e-6)
+        out = ("{} files, {:.1f} MiB in {:.1f}s "
+                "({:.1f} MiB/s, {:.0f} files/s)").format(
+                self.files, self.bytes / 2**20, elapsed,
+                self.bytes / 2**20 / elapsed, self.files / elapsed)
+        if self.unchanged or self.removed:
+            out += ", {} unchanged, {} removed".format(
+                    self.unchanged, self.removed)
+        return out
+
+
+def _reflink(src_fd, dst_fd):
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+def _copy_file_range(src_fd, dst_fd, size):
+    copied = 0
+    while copied < size:
+        n = os.copy_file_range(src_fd, dst_fd, size - copied)
+        if n == 0:
+            break
+        copied += n
+    return copied
+
+def _stream(src_fd, dst_fd):
+    buf = bytearray(BUFFER_SIZE)
+    view = memoryview(buf)
+    with open(src_fd, 'rb', buffering=0, closefd=False) as fsrc, \
+            open(dst_fd, 'wb', buffering=0, closefd=False) as fdst:
+        while True:
+            n = fsrc.readinto(buf)
+            if not n:
+                break
+            fdst.write(view[:n])
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(BUFFER_SIZE)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+def copy_file(src, dst):
+    """Copy the content and the metadata of a regular file.
+
+    Returns the number of bytes copied.
+    """
+    src_st = os.stat(src)
+    dst_dev = os.stat(os.path.dirname(dst) or '.').st_dev
+    same_fs = src_st.st_dev == dst_dev
+
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            done = False
+            if same_fs:
+                try:
+                    _reflink(src_fd, dst_fd)
+                    done = True
+                except OSError as e:
+                    if e.errno not in _FALLBACK_ERRNOS:
+                        raise
+                if not done:
+                    try:
+                        _copy_file_range(src_fd, dst_fd, src_st.st_size)
+                        done = True
+                    except OSError as e:
+                        if e.errno not in _FALLBACK_ERRNOS:
+                            raise
+                        # it may fail part way, after moving both offsets
+                        os.lseek(src_fd, 0, os.SEEK_SET)
+                        os.lseek(dst_fd, 0, os.SEEK_SET)
+                        os.ftruncate(dst_fd, 0)
+            if not done:
+                _stream(src_fd, dst_fd)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+    shutil.copystat(src, dst)
+    return src_st.st_size
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+class Manifest:
+    """Size, mtime and optionally sha256 of every copied file.
+
+    Keyed by the absolute target path and stored as json.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+
+    def get(self, dst):
+        with self._lock:
+            return self.entries.get(dst)
+
+    def set(self, dst, entry):
+        with self._lock:
+            self.entries[dst] = entry
+
+    def discard(self, dst):
+        with self._lock:
+            self.entries.pop(dst, None)
+
+    def under(self, dir_):
+        prefix = dir_.rstrip('/') + '/'
+        with self._lock:
+            return [k for k in self.entries if k.startswith(prefix)]
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._lock:
+            content = json.dumps(self.entries)
+        write_file(self.path, content)
+
+
+class Copier:
+    """Copy files and trees on a bounded pool of threads.
+
+    Behaves like shutil.copy2() and shutil.copytree(symlinks=True): symlinks
+    are recreated, not followed, and the files end up owned by the calling
+    user. Errors are collected and raised as shutil.Error by wait().
+
+    If manifest is given, the copier runs in sync mode: existing targets are
+    allowed, unchanged files are skipped, and files recorded in the manifest
+    but gone from a source tree are removed. Files queued with copy() alone
+    are never removed, since the copier cannot tell a file no longer wanted
+    from one not queued in this run. With checksum, files whose mtime
+    changed but whose content did not are not copied again.
+    """
+    def __init__(self, workers=DEFAULT_WORKERS, manifest=None, checksum=False):
+        self.stats = CopyStats()
+        self.errors = []
+        self.manifest = Manifest(manifest) if manifest is not None else None
+        self.checksum = checksum
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        # bound the number of queued files, so that a huge tree does not
+        # pile up in memory before it is copied
+        self._slots = threading.BoundedSemaphore(workers * 4)
+        self._dirs = []
+        self._seen = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.wait()
+        else:
+            self._pool.shutdown(wait=True)
+            # the files copied so far are not copied again by the next run
+            if self.manifest is not None:
+                self.manifest.save()
+
+    def _error(self, src, dst, why):
+        with self._lock:
+            self.errors.append((src, dst, str(why)))
+
+    def _unchanged(self, src, dst):
+        entry = self.manifest.get(dst)
+        if entry is None or 'link' in entry:
+            return False
+        try:
+            src_st = os.stat(src)
+            dst_st = os.lstat(dst)
+        except FileNotFoundError:
+            return False
+        if (dst_st.st_size != entry['size']
+                or dst_st.st_mtime_ns != entry['mtime_ns']):
+            # modified in the target
+            return False
+        if (src_st.st_size == entry['size']
+                and src_st.st_mtime_ns == entry['mtime_ns']):
+            return True
+        if (self.checksum and entry.get('sha256')
+                and src_st.st_size == entry['size']
+                and file_hash(src) == entry['sha256']):
+            # only touched
+            shutil.copystat(src, dst)
+            self._record(src, dst)
+            return True
+        return False
+
+    def _record(self, src, dst):
+        st = os.stat(src)
+        entry = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+        if self.checksum:
+            entry['sha256'] = file_hash(dst)
+        self.manifest.set(dst, entry)
+
+    def _copy_job(self, src, dst):
+        try:
+            if self.manifest is not None:
+                if self._unchanged(src, dst):
+                    self.stats.skip()
+                    return
+                if os.path.islink(dst) or os.path.isdir(dst):
+                    _remove(dst)
+            self.stats.add(copy_file(src, dst))
+            if self.manifest is not None:
+                self._record(src, dst)
+        except OSError as why:
+            self._error(src, dst, why)
+        finally:
+            self._slots.release()
+
+    def copy(self, src, dst):
+        """Queue a single file, dst being the full target path."""
+        if self._seen is not None:
+            self._seen.add(dst)
+        self._slots.acquire()
+        self._pool.submit(self._copy_job, src, dst)
+
+    def _copy_symlink(self, src, dst):
+        if self._seen is not None:
+            self._seen.add(dst)
+        try:
+            link = os.readlink(src)
+            if self.manifest is not None and os.path.lexists(dst):
+                if os.path.islink(dst) and os.readlink(dst) == link:
+                    self.stats.skip()
+                    # also for manifests from before links were recorded
+                    self.manifest.set(dst, {'link': link})
+                    return
+                _remove(dst)
+            os.symlink(link, dst)
+            shutil.copystat(src, dst, follow_symlinks=False)
+            self.stats.add(0)
+            if self.manifest is not None:
+                # so that _prune removes it once it is gone from the source
+                self.manifest.set(dst, {'link': link})
+        except OSError as why:
+            self._error(src, dst, why)
+
+    def copytree(self, src, dst):
+        """Queue a directory tree.
+
+        dst must not exist, unless in sync mode.
+        """
+        sync = self.manifest is not None
+        if sync:
+            self._seen = set()
+        os.makedirs(dst, exist_ok=sync)
+        self._dirs.append((src, dst))
+        for root, dirs, files in os.walk(src):
+            rel = os.path.relpath(root, src)
+            target_root = os.path.normpath(os.path.join(dst, rel))
+            for name in list(dirs):
+                s = os.path.join(root, name)
+                d = os.path.join(target_root, name)
+                if os.path.islink(s):
+                    # os.walk does not follow it, but it still shows up
+                    # in dirs
+                    dirs.remove(name)
+                    self._copy_symlink(s, d)
+                    continue
+                try:
+                    if not (sync and os.path.isdir(d)
+                            and not os.path.islink(d)):
+                        if sync and os.path.lexists(d):
+                            _remove(d)
+                        os.mkdir(d)
+                    self._dirs.append((s, d))
+                except OSError as why:
+                    self._error(s, d, why)
+                    dirs.remove(name)
+            for name in files:
+                s = os.path.join(root, name)
+                d = os.path.join(target_root, name)
+                try:
+                    mode = os.lstat(s).st_mode
+                except OSError as why:
+                    self._error(s, d, why)
+                    continue
+                if stat.S_ISLNK(mode):
+                    self._copy_symlink(s, d)
+                elif stat.S_ISREG(mode):
+                    self.copy(s, d)
+                else:
+                    self._error(s, d, "`{}` is not a regular file".format(s))
+        if sync:
+            self._prune(src, dst, self._seen)
+            self._seen = None
+
+    def _prune(self, src, dst, seen):
+        # only what we copied before is removed, files created in the
+        # target by other means are left alone
+        for path in self.manifest.under(dst):
+            if path in seen:
+                continue
+            self.manifest.discard(path)
+            try:
+                _remove(path)
+                self.stats.remove()
+            except FileNotFoundError:
+                pass
+            except OSError as why:
+                self._error(None, path, why)
+        for root, dirs, files in os.walk(dst, topdown=False):
+            rel = os.path.relpath(root, dst)
+            if rel == '.' or files or dirs:
+                continue
+            if not os.path.isdir(os.path.join(src, rel)):
+                try:
+                    os.rmdir(root)
+                except OSError:
+                    pass
+
+    def wait(self):
+        """Wait for all queued files and fix up directory metadata."""
+        self._pool.shutdown(wait=True)
+        # done after the content, since adding files changes the mtime
+        for src, dst in reversed(self._dirs):
+            try:
+                shutil.copystat(src, dst)
+            except OSError as why:
+                self._error(src, dst, why)
+        self._dirs = []
+        if self.manifest is not None:
+            self.manifest.save()
+        if self.errors:
+            raise shutil.Error(self.errors)
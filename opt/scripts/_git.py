@@ -0,0 +1,102 @@
+"""Git helpers backed by a local cache of bare mirrors.
+
+The mirrors are updated on the host, and clones or fetches then take their
+objects from the mirror, so that only the objects the mirror does not have
+yet are transferred over the network. All ssh connections share one
+ControlMaster connection per host.
+"""
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+
+GIT_CACHE_DIR = '/var/cache/arch-config/git'
+
+SSH_COMMAND = ('ssh -o ControlMaster=auto -o ControlPersist=60 '
+        '-o ControlPath={}/ssh-git-%C').format(tempfile.gettempdir())
+
+# the mirrors are owned by root, but are also read by other users
+GIT = ['git', '-c', 'safe.directory=*']
+
+
+def git_env(env=None):
+    env = dict(os.environ if env is None else env)
+    env.setdefault('GIT_SSH_COMMAND', SSH_COMMAND)
+    return env
+
+def mirror_path(url, cache_dir=GIT_CACHE_DIR):
+    """Path of the mirror of url, e.g. <cache_dir>/github.com/user/repo.git"""
+    if '://' in url:
+        parts = urlsplit(url)
+        host, path = parts.hostname or 'local', parts.path
+    elif ':' in url:
+        # scp-like syntax: user@host:path
+        host, path = url.split(':', 1)
+        host = host.rsplit('@', 1)[-1]
+    else:
+        host, path = 'local', url
+    path = path.strip('/')
+    if not path.endswith('.git'):
+        path += '.git'
+    return os.path.join(cache_dir, host, path)
+
+def _has_mirror(url, cache_dir):
+    return cache_dir is not None and os.path.isdir(mirror_path(url, cache_dir))
+
+def update_mirror_cmds(url, cache_dir=GIT_CACHE_DIR):
+    path = mirror_path(url, cache_dir)
+    if os.path.isdir(path):
+        return [GIT + ['-C', path, 'remote', 'update', '--prune']]
+    return [GIT + ['clone', '--mirror', url, path]]
+
+def clone_cmds(url, dest, cache_dir=GIT_CACHE_DIR, recursive=False):
+    cmd = GIT + ['clone']
+    if recursive:
+        cmd.append('--recursive')
+    if _has_mirror(url, cache_dir):
+        # dissociate, so that the clone still works without the cache
+        cmd += ['--reference', mirror_path(url, cache_dir), '--dissociate']
+    return [cmd + [url, dest]]
+
+def checkout_cmds(url, cache_dir=GIT_CACHE_DIR, branch='master'):
+    """Turn the current directory into a checkout of url."""
+    cmds = [
+        GIT + ['init'],
+        GIT + ['remote', 'add', 'origin', url],
+    ]
+    if _has_mirror(url, cache_dir):
+        cmds.append(GIT + ['fetch', mirror_path(url, cache_dir),
+            '+refs/heads/*:refs/remotes/origin/*'])
+    cmds += [
+        GIT + ['fetch', 'origin'],
+        GIT + ['checkout', '-t', '-f', 'origin/' + branch],
+    ]
+    return cmds
+
+def run_parallel(jobs, run_f, max_workers=4, **kwargs):
+    """Run lists of commands concurrently, each list in order.
+
+    jobs is a list of (cmds, cwd). run_f is called as
+    run_f(cmd, cwd=cwd, env=..., **kwargs), e.g. _utils.run or
+    functools.partial(_utils.run_as_user, user).
+    """
+    env = git_env(kwargs.pop('env', None))
+
+    def _job(cmds, cwd):
+        for cmd in cmds:
+            run_f(cmd, cwd=cwd, env=env, **kwargs)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(_job, cmds, cwd) for cmds, cwd in jobs]
+        for future in futures:
+            future.result()
+
+def update_mirrors(urls, run_f, cache_dir=GIT_CACHE_DIR):
+    print("Updating git mirrors in {}...".format(cache_dir))
+    os.makedirs(cache_dir, exist_ok=True)
+    for url in urls:
+        os.makedirs(os.path.dirname(mirror_path(url, cache_dir)),
+                exist_ok=True)
+    run_parallel([(update_mirror_cmds(url, cache_dir), None) for url in urls],
+            run_f)
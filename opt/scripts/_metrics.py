@@ -0,0 +1,158 @@
+"""Simple metrics in the Prometheus text format.
+
+Metrics can be written to a text file (e.g. for the node_exporter textfile
+collector) or served over http.
+"""
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from _utils import write_file
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v)
+            for k, v in sorted(labels)) + '}'
+
+
+class _Metric:
+    type_ = None
+
+    def __init__(self, registry, name, help_):
+        self.name = name
+        self.help = help_
+        self._lock = registry._lock
+        self._values = {}
+        registry.metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def lines(self):
+        yield '# HELP {} {}'.format(self.name, self.help)
+        yield '# TYPE {} {}'.format(self.name, self.type_)
+        for labels, value in sorted(self._values.items()):
+            yield '{}{} {}'.format(self.name, _format_labels(labels), value)
+
+
+class Counter(_Metric):
+    type_ = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def total(self):
+        return sum(self._values.values())
+
+
+class Gauge(_Metric):
+    type_ = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels))
+
+
+class Histogram(_Metric):
+    type_ = 'histogram'
+
+    def __init__(self, registry, name, help_, buckets):
+        super().__init__(registry, name, help_)
+        self.buckets = sorted(buckets)
+        # labels -> [bucket counts, sum, count]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.setdefault(
+                    key, [[0] * len(self.buckets), 0.0, 0])
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def quantile(self, q, **labels):
+        """Estimate a quantile, as the upper bound of its bucket."""
+        state = self._values.get(self._key(labels))
+        if state is None or state[2] == 0:
+            return None
+        rank = q * state[2]
+        cumulative = 0
+        for bound, n in zip(self.buckets, state[0]):
+            cumulative += n
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def lines(self):
+        yield '# HELP {} {}'.format(self.name, self.help)
+        yield '# TYPE {} histogram'.format(self.name)
+        for labels, (counts, sum_, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield '{}_bucket{} {}'.format(self.name,
+                        _format_labels(labels + (('le', bound),)), cumulative)
+            yield '{}_bucket{} {}'.format(self.name,
+                    _format_labels(labels + (('le', '+Inf'),)), count)
+            yield '{}_sum{} {}'.format(self.name, _format_labels(labels), sum_)
+            yield '{}_count{} {}'.format(self.name, _format_labels(labels),
+                    count)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self._lock = threading.Lock()
+
+    def counter(self, name, help_):
+        return Counter(self, name, help_)
+
+    def gauge(self, name, help_):
+        return Gauge(self, name, help_)
+
+    def histogram(self, name, help_, buckets):
+        return Histogram(self, name, help_, buckets)
+
+    def text(self):
+        with self._lock:
+            lines = [line for m in self.metrics for line in m.lines()]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        # rewritten every few seconds, not worth an fsync
+        write_file(path, self.text(), sync=False)
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serve /metrics over http in a background thread."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.text().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                        'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
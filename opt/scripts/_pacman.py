@@ -0,0 +1,414 @@
+"""Helpers for working with pacman and package lists."""
+import os
+import re
+import json
+import tarfile
+import subprocess
+from collections import namedtuple
+
+from _utils import run, write_file
+
+
+PACMAN_DB_DIR = '/var/lib/pacman'
+PACKAGE_CACHE_DIR = '/var/cache/pacman/pkg'
+# dbs of the packages prefetched for a new system, apart from the host's
+PREFETCH_DB_DIR = '/var/cache/arch-config/pacman-db'
+
+# reasons in the local db
+REASON_EXPLICIT = 0
+REASON_DEPEND = 1
+
+# the fields of desc files we keep
+_DESC_FIELDS = ['NAME', 'VERSION', 'REASON', 'DEPENDS', 'PROVIDES', 'GROUPS']
+
+# repo is None for foreign packages, i.e. not in any sync db
+LocalPackage = namedtuple('LocalPackage',
+        ['name', 'version', 'reason', 'repo', 'depends', 'provides', 'groups'])
+
+
+def parse_package_list(text):
+    pkgs = [line.strip() for line in text.splitlines()]
+    return [pkg for pkg in pkgs if pkg and not pkg.startswith('#')]
+
+def read_package_list(path):
+    with open(path) as f:
+        return parse_package_list(f.read())
+
+def _pacman_words(*args):
+    out = subprocess.run(['pacman', *args], stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL).stdout
+    return out.decode().split()
+
+def installed_packages():
+    return set(_pacman_words('-Qq'))
+
+def explicit_packages():
+    return set(_pacman_words('-Qqe'))
+
+def sync_packages(db_dir=None):
+    """Names of all packages and groups in the sync databases."""
+    dbpath = ['--dbpath', db_dir] if db_dir else []
+    names = set(_pacman_words(*dbpath, '-Slq'))
+    groups = subprocess.run(['pacman', *dbpath, '-Sg'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL).stdout.decode()
+    names.update(line.split()[0] for line in groups.splitlines()
+            if line.strip())
+    return names
+
+def _strip_version(dep):
+    return re.split(r'[<>=:]', dep, 1)[0]
+
+def parse_info(text):
+    """Parse the output of `pacman -Si/-Qi` into a list of dicts."""
+    pkgs = []
+    pkg = {}
+    key = None
+    for line in text.splitlines():
+        if not line.strip():
+            if pkg:
+                pkgs.append(pkg)
+            pkg = {}
+            key = None
+            continue
+        if line[0].isspace() and key is not None:
+            pkg[key] += ' ' + line.strip()
+            continue
+        key, _, value = line.partition(':')
+        key = key.strip()
+        pkg[key] = value.strip()
+    if pkg:
+        pkgs.append(pkg)
+    return pkgs
+
+def _info_list(value):
+    if not value or value == 'None':
+        return []
+    return value.split()
+
+def sync_depends(pkgs):
+    """Return {name: set of dependencies among pkgs} from the sync DBs."""
+    if not pkgs:
+        return {}
+    out = subprocess.run(['pacman', '-Si', *sorted(pkgs)],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    infos = parse_info(out.decode())
+
+    # resolve dependencies on provided names, e.g. 'sh'
+    providers = {}
+    for info in infos:
+        name = info['Name']
+        providers[name] = name
+        for prov in _info_list(info.get('Provides')):
+            providers.setdefault(_strip_version(prov), name)
+
+    depends = {pkg: set() for pkg in pkgs}
+    for info in infos:
+        name = info['Name']
+        if name not in depends:
+            continue
+        for dep in _info_list(info.get('Depends On')):
+            dep = providers.get(_strip_version(dep))
+            if dep is not None and dep != name and dep in depends:
+                depends[name].add(dep)
+    return depends
+
+def dependency_batches(depends, batch_size):
+    """Split packages into batches, dependencies first.
+
+    depends is {name: set of names}. Dependency cycles are broken
+    arbitrarily.
+    """
+    remaining = {pkg: set(deps) for pkg, deps in depends.items()}
+    order = []
+    while remaining:
+        ready = sorted(pkg for pkg, deps in remaining.items() if not deps)
+        if not ready:
+            # a cycle, take the one with the fewest dependencies left
+            ready = [min(remaining, key=lambda p: (len(remaining[p]), p))]
+        for pkg in ready:
+            del remaining[pkg]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+        order.extend(ready)
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+class InstallPlan:
+    def __init__(self, missing, obsolete, unknown, batches):
+        self.missing = missing
+        self.obsolete = obsolete
+        self.unknown = unknown
+        self.batches = batches
+
+    def print_summary(self):
+        print("\t{} packages to install in {} batches".format(
+            len(self.missing), len(self.batches)))
+        if self.unknown:
+            print("\tWARNING: skipping unknown packages: {}".format(
+                ' '.join(sorted(self.unknown))))
+        if self.obsolete:
+            print("\tinstalled explicitly but not in the list: {}".format(
+                ' '.join(sorted(self.obsolete))))
+
+def plan_install(wanted, batch_size=50):
+    """Compute what is missing from the system.
+
+    The sync databases should be refreshed before calling this. Groups
+    in wanted (e.g. from gen_installed_packages.py --minimize) stand for
+    their members.
+    """
+    wanted = expand_groups(wanted, sync_groups())
+    installed = installed_packages()
+    available = sync_packages()
+
+    unknown = {pkg for pkg in wanted - installed if pkg not in available}
+    missing = wanted - installed - unknown
+    obsolete = explicit_packages() - wanted
+    batches = dependency_batches(sync_depends(missing), batch_size)
+    return InstallPlan(missing, obsolete, unknown, batches)
+
+def install_batches(batches):
+    """Install batches of packages, returns the packages that failed.
+
+    If a batch fails, its packages are retried one by one, so that a bad
+    package does not stop the others. Since the plan is computed from what
+    is installed, a re-run resumes where this one stopped.
+    """
+    failed = []
+    cmd = ['pacman', '-S', '--needed', '--noconfirm', '--asexplicit']
+    for i, batch in enumerate(batches, 1):
+        print("\tbatch {}/{}: {} packages".format(i, len(batches), len(batch)))
+        try:
+            run(cmd + batch)
+        except subprocess.CalledProcessError:
+            for pkg in batch:
+                try:
+                    run(cmd + [pkg])
+                except subprocess.CalledProcessError:
+                    failed.append(pkg)
+    return failed
+
+def prefetch(pkgs, db_dir=PREFETCH_DB_DIR, cache_dir=PACKAGE_CACHE_DIR,
+        refresh=True, run_f=run):
+    """Download pkgs and all their dependencies into cache_dir.
+
+    The sync dbs are kept in db_dir, with an empty local db, so that the
+    whole dependency closure is downloaded as for a new system, and the
+    host's dbs are neither touched nor locked. Returns the names not found
+    in the sync dbs, which are skipped.
+    """
+    os.makedirs(os.path.join(db_dir, 'local'), exist_ok=True)
+    cmd = ['pacman', '--dbpath', db_dir, '--cachedir', cache_dir,
+            '--noconfirm']
+    if refresh:
+        run_f(cmd + ['-Sy'])
+    available = sync_packages(db_dir)
+    unknown = [pkg for pkg in pkgs if pkg not in available]
+    known = [pkg for pkg in pkgs if pkg in available]
+    if known:
+        run_f(cmd + ['-Sw', *known])
+    return unknown
+
+
+def parse_desc(text):
+    """Parse a desc file of the local db into {FIELD: [values]}."""
+    fields = {}
+    key = None
+    for line in text.splitlines():
+        if line.startswith('%') and line.endswith('%') and len(line) > 2:
+            key = line[1:-1]
+            fields[key] = []
+        elif line and key is not None:
+            fields[key].append(line)
+        else:
+            key = None
+    return fields
+
+def _read_sync_db(path):
+    names = set()
+    try:
+        with tarfile.open(path) as tar:
+            for member in tar:
+                if member.isfile() and member.name.endswith('/desc'):
+                    desc = parse_desc(tar.extractfile(member).read().decode())
+                    names.update(desc.get('NAME', []))
+    except tarfile.ReadError:
+        # e.g. zstd compressed, leave it to pacman
+        repo = os.path.basename(path)[:-len('.db')]
+        names.update(_pacman_words('-Slq', repo))
+    return names
+
+
+class LocalDB:
+    """Reader for the local pacman db, without running pacman.
+
+    The parsed desc files and the package names of the sync dbs are kept
+    in an index file, keyed by mtime, so that only what changed since the
+    last run is parsed again.
+    """
+    def __init__(self, db_dir=PACMAN_DB_DIR, index_file=None):
+        self.db_dir = db_dir
+        self.index_file = index_file
+        self.index = {'local': {}, 'sync': {}}
+        if index_file is not None:
+            try:
+                with open(index_file) as f:
+                    self.index = json.load(f)
+            except (FileNotFoundError, ValueError):
+                pass
+
+    def _local_entries(self):
+        local_dir = os.path.join(self.db_dir, 'local')
+        old = self.index['local']
+        new = {}
+        for entry in os.scandir(local_dir):
+            if not entry.is_dir():
+                continue
+            desc_path = os.path.join(entry.path, 'desc')
+            try:
+                # not the mtime of the dir, since pacman rewrites desc in
+                # place, e.g. with `pacman -D --asexplicit`
+                mtime = os.stat(desc_path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            cached = old.get(entry.name)
+            if cached is not None and cached['mtime_ns'] == mtime:
+                new[entry.name] = cached
+                continue
+            with open(desc_path) as f:
+                desc = parse_desc(f.read())
+            fields = {k: desc.get(k, []) for k in _DESC_FIELDS}
+            new[entry.name] = {'mtime_ns': mtime, 'fields': fields}
+        self.index['local'] = new
+        return new
+
+    def _sync_names(self):
+        """Return {repo: set of names}."""
+        sync_dir = os.path.join(self.db_dir, 'sync')
+        old = self.index['sync']
+        new = {}
+        repos = {}
+        try:
+            files = sorted(os.listdir(sync_dir))
+        except FileNotFoundError:
+            files = []
+        for file_ in files:
+            if not file_.endswith('.db'):
+                continue
+            path = os.path.join(sync_dir, file_)
+            repo = file_[:-len('.db')]
+            mtime = os.stat(path).st_mtime_ns
+            cached = old.get(repo)
+            if cached is not None and cached['mtime_ns'] == mtime:
+                names = cached['names']
+            else:
+                names = sorted(_read_sync_db(path))
+            new[repo] = {'mtime_ns': mtime, 'names': names}
+            repos[repo] = set(names)
+        self.index['sync'] = new
+        return repos
+
+    def packages(self):
+        """Return {name: LocalPackage} of all installed packages."""
+        repos = self._sync_names()
+        pkgs = {}
+        for entry in self._local_entries().values():
+            fields = entry['fields']
+            name = fields['NAME'][0]
+            reason = int(fields['REASON'][0]) if fields['REASON'] \
+                    else REASON_EXPLICIT
+            repo = next((r for r, names in repos.items() if name in names),
+                    None)
+            pkgs[name] = LocalPackage(name, fields['VERSION'][0], reason, repo,
+                    fields['DEPENDS'], fields['PROVIDES'], fields['GROUPS'])
+        self.save_index()
+        return pkgs
+
+    def save_index(self):
+        if self.index_file is None:
+            return
+        os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+        # only a cache, no need to sync
+        write_file(self.index_file, json.dumps(self.index), sync=False)
+
+
+def sync_groups():
+    """Return {group: set of member names} from the sync databases."""
+    out = subprocess.run(['pacman', '-Sg'], stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL).stdout.decode()
+    groups = {}
+    for line in out.splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            groups.setdefault(parts[0], set()).add(parts[1])
+    return groups
+
+def dependency_graph(pkgs):
+    """Return {name: set of names} of installed packages.
+
+    pkgs is {name: LocalPackage}. Dependencies on provided names are
+    resolved to the installed package providing them.
+    """
+    providers = {}
+    for pkg in pkgs.values():
+        for prov in pkg.provides:
+            providers.setdefault(_strip_version(prov), pkg.name)
+    providers.update((name, name) for name in pkgs)
+
+    graph = {}
+    for pkg in pkgs.values():
+        deps = (providers.get(_strip_version(dep)) for dep in pkg.depends)
+        graph[pkg.name] = {dep for dep in deps if dep is not None}
+    return graph
+
+def closure(roots, graph):
+    seen = set()
+    stack = list(roots)
+    while stack:
+        name = stack.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        stack.extend(graph.get(name, ()))
+    return seen
+
+def minimize_roots(roots, graph, groups=None):
+    """Drop the roots already pulled in by another root.
+
+    Returns (new_roots, pulled_in_by), new_roots having the same closure
+    as roots. In a dependency cycle, the first root by name is kept. If
+    groups ({group: members}) is given, members are replaced by their
+    group where the whole group is already part of the closure.
+    """
+    roots = sorted(set(roots))
+    reach = {r: closure(graph.get(r, ()), graph) for r in roots}
+    pulled_in_by = {}
+    for r in roots:
+        for s in roots:
+            if s == r or r not in reach[s]:
+                continue
+            if s in reach[r] and s > r:
+                # a cycle, keep r
+                continue
+            pulled_in_by[r] = s
+            break
+    new_roots = [r for r in roots if r not in pulled_in_by]
+
+    if groups:
+        full = closure(roots, graph)
+        for group, members in sorted(groups.items()):
+            covered = members & set(new_roots)
+            if len(covered) < 2 or not members <= full:
+                continue
+            new_roots = [r for r in new_roots if r not in covered]
+            new_roots.append(group)
+            for r in covered:
+                pulled_in_by[r] = group
+    return sorted(new_roots), pulled_in_by
+
+def expand_groups(roots, groups):
+    out = set()
+    for r in roots:
+        out.update(groups.get(r, {r}) if groups else {r})
+    return out
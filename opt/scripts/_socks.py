@@ -0,0 +1,257 @@
+"""SOCKS5 helpers.
+
+A minimal client, used to check the data path of a proxy, and a front-end
+spreading connections over several SOCKS5 backends.
+"""
+import socket
+import struct
+import asyncio
+import threading
+from time import monotonic, sleep
+
+
+class SocksError(Exception):
+    pass
+
+
+def _recv_exact(sock, n):
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise SocksError("connection closed by proxy")
+        data += chunk
+    return data
+
+def socks_connect(proxy, host, port, timeout):
+    """Connect to host:port through the SOCKS5 proxy (host, port).
+
+    Only the no-authentication method is supported.
+    """
+    sock = socket.create_connection(proxy, timeout=timeout)
+    try:
+        sock.sendall(b'\x05\x01\x00')
+        ver, method = _recv_exact(sock, 2)
+        if ver != 5 or method != 0:
+            raise SocksError("proxy refused the authentication method")
+        host_bytes = host.encode('idna')
+        sock.sendall(b'\x05\x01\x00\x03' + bytes([len(host_bytes)])
+                + host_bytes + struct.pack('!H', port))
+        ver, rep, _, atyp = _recv_exact(sock, 4)
+        if ver != 5:
+            raise SocksError("bad reply from proxy")
+        if rep != 0:
+            raise SocksError("proxy reply code {}".format(rep))
+        if atyp == 1:
+            _recv_exact(sock, 4 + 2)
+        elif atyp == 4:
+            _recv_exact(sock, 16 + 2)
+        elif atyp == 3:
+            _recv_exact(sock, _recv_exact(sock, 1)[0] + 2)
+        else:
+            raise SocksError("bad address type {}".format(atyp))
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+class ProbeResult:
+    def __init__(self, connect_time, rtt, throughput):
+        self.connect_time = connect_time
+        self.rtt = rtt
+        self.throughput = throughput
+
+    def __str__(self):
+        out = "connect {:.0f} ms, rtt {:.0f} ms".format(
+                self.connect_time * 1000, self.rtt * 1000)
+        if self.throughput is not None:
+            out += ", {:.1f} KiB/s".format(self.throughput / 1024)
+        return out
+
+
+def _recv_until(sock, expected):
+    received = 0
+    while received < expected:
+        data = sock.recv(65536)
+        if not data:
+            break
+        received += len(data)
+    return received
+
+def probe(proxy, host, port, mode='http', path='/', sample_bytes=64 * 1024,
+        timeout=5):
+    """Send a request through the proxy and time the answer.
+
+    In 'http' mode a GET request for path is sent, and rtt is the time to
+    the first byte of the answer. In 'echo' mode a single byte is echoed to
+    measure rtt, then sample_bytes are sent and expected back. throughput
+    is the amount of data received (the body in 'http' mode) divided by
+    the time it took, or None if there is no body, e.g. for a 204.
+    """
+    start = monotonic()
+    sock = socks_connect(proxy, host, port, timeout)
+    with sock:
+        connect_time = monotonic() - start
+        if mode == 'http':
+            request = ("GET {} HTTP/1.1\r\nHost: {}\r\n"
+                    "Connection: close\r\n\r\n").format(path, host).encode()
+            start = monotonic()
+            sock.sendall(request)
+            first = sock.recv(65536)
+            if not first:
+                raise SocksError("no answer from {}:{}".format(host, port))
+            rtt = monotonic() - start
+            head = first
+            while b'\r\n\r\n' not in head:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                head += data
+            # the headers say nothing about the throughput
+            body = len(head.partition(b'\r\n\r\n')[2])
+            received = body + _recv_until(sock, sample_bytes - body)
+        elif mode == 'echo':
+            start = monotonic()
+            sock.sendall(b'x')
+            if not sock.recv(1):
+                raise SocksError("no answer from {}:{}".format(host, port))
+            rtt = monotonic() - start
+            start = monotonic()
+            sock.sendall(b'x' * sample_bytes)
+            received = _recv_until(sock, sample_bytes)
+        else:
+            raise ValueError("unknown mode {}".format(mode))
+        elapsed = monotonic() - start
+        throughput = None
+        if received:
+            throughput = received / elapsed if elapsed > 0 else 0.0
+    return ProbeResult(connect_time, rtt, throughput)
+
+
+class Backend:
+    """A SOCKS5 server on a local port, as seen by SocksBalancer."""
+    def __init__(self, port):
+        self.port = port
+        self.active = 0
+        self.healthy = False
+        self.draining = False
+        # latest round trip time, used by the 'latency' strategy
+        self.rtt = None
+
+    def __repr__(self):
+        return 'Backend({})'.format(self.port)
+
+
+class SocksBalancer:
+    """Spread SOCKS5 connections over several backends.
+
+    Every client connection is relayed as is to one backend, so the SOCKS
+    handshake itself is done by the backend. New connections go to the
+    healthy backend with the fewest active connections ('least-conn') or
+    with the lowest rtt ('latency'). The server runs in its own thread.
+    """
+    def __init__(self, port, backends, strategy='least-conn',
+            host='127.0.0.1'):
+        if strategy not in ('least-conn', 'latency'):
+            raise ValueError("unknown strategy {}".format(strategy))
+        self.host = host
+        self.port = port
+        self.backends = backends
+        self.strategy = strategy
+        self._turn = 0
+        self._loop = None
+        self._ready = threading.Event()
+
+    def _candidates(self, tried):
+        backends = [b for b in self.backends
+                if b.healthy and not b.draining and b not in tried]
+        # ties are broken round robin
+        n = len(self.backends)
+        self._turn = (self._turn + 1) % n
+        turn = {b: (i - self._turn) % n for i, b in enumerate(self.backends)}
+        inf = float('inf')
+        if self.strategy == 'latency':
+            key = lambda b: (b.rtt if b.rtt is not None else inf, b.active,
+                    turn[b])
+        else:
+            key = lambda b: (b.active, turn[b])
+        return sorted(backends, key=key)
+
+    async def _connect_backend(self):
+        tried = set()
+        while True:
+            candidates = self._candidates(tried)
+            if not candidates:
+                return None, None, None
+            backend = candidates[0]
+            tried.add(backend)
+            try:
+                reader, writer = await asyncio.open_connection(
+                        '127.0.0.1', backend.port)
+                return backend, reader, writer
+            except OSError:
+                # nothing has been sent yet, so try the next one
+                backend.healthy = False
+
+    async def _pipe(self, reader, writer):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except OSError:
+            pass
+        finally:
+            try:
+                writer.write_eof()
+            except (OSError, RuntimeError):
+                pass
+
+    async def _handle(self, client_reader, client_writer):
+        backend, reader, writer = await self._connect_backend()
+        if backend is None:
+            client_writer.close()
+            return
+        backend.active += 1
+        try:
+            await asyncio.gather(self._pipe(client_reader, writer),
+                    self._pipe(reader, client_writer))
+        finally:
+            backend.active -= 1
+            writer.close()
+            client_writer.close()
+
+    async def _serve(self):
+        server = await asyncio.start_server(self._handle, self.host,
+                self.port, reuse_address=True)
+        self._ready.set()
+        async with server:
+            await server.serve_forever()
+
+    def start(self):
+        """Start serving in a background thread."""
+        error = []
+
+        def _run():
+            self._loop = asyncio.new_event_loop()
+            try:
+                self._loop.run_until_complete(self._serve())
+            except BaseException as e:
+                error.append(e)
+                self._ready.set()
+        threading.Thread(target=_run, daemon=True).start()
+        self._ready.wait()
+        if error:
+            raise error[0]
+
+    def drain(self, backend, timeout):
+        """Stop sending new connections to backend, and wait for the
+        active ones to finish. Returns True if it is idle."""
+        backend.draining = True
+        deadline = monotonic() + timeout
+        while backend.active > 0 and monotonic() < deadline:
+            sleep(0.1)
+        return backend.active == 0
@@ -0,0 +1,234 @@
+"""Run the steps of a script with checkpoints.
+
+Each step has a fingerprint made of the hashes of its input and output
+files. When a step finishes, its fingerprint is saved to a state file, so
+that a re-run with --resume skips the steps that are already done and
+whose files have not changed since.
+
+Steps declare the steps they depend on, and are run concurrently on a
+bounded pool once their dependencies are done. The questions a step needs
+answered are asked by its prompt function, and the prompts of all the
+steps are asked at the start, so that the rest can run unattended. A step
+which still needs the terminal is marked interactive, and runs alone, and
+one which can start before the questions (e.g. a download) is marked
+early.
+"""
+import os
+import json
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from _utils import TIMELINE, stop_commands, write_file
+
+
+class Step:
+    """A step of a script.
+
+    If prompt is given, it is called before any step is run, and its
+    result is passed to f. An early step (without deps or prompt) is
+    started before the prompts are asked, so that e.g. a download runs
+    while the user answers them. It should print nothing, not to mix
+    with the questions, and its commands are terminated if a prompt
+    fails.
+    """
+    def __init__(self, f, inputs=(), outputs=(), deps=(), prompt=None,
+            interactive=False, early=False, name=None):
+        self.f = f
+        # also for functools.partial
+        self.name = name or getattr(f, 'func', f).__name__
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        self.prompt = prompt
+        self.interactive = interactive
+        self.early = early
+
+    def __repr__(self):
+        return 'Step({})'.format(self.name)
+
+
+def _hash_files(paths):
+    h = hashlib.sha256()
+    for path in paths:
+        h.update(path.encode() + b'\0')
+        try:
+            with open(path, 'rb') as f:
+                while True:
+                    data = f.read(1024 * 1024)
+                    if not data:
+                        break
+                    h.update(data)
+        except FileNotFoundError:
+            h.update(b'<missing>')
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class StepState:
+    """Fingerprints of finished steps, and some saved variables.
+
+    With path None, the state is only kept in memory.
+    """
+    def __init__(self, path):
+        self.path = path
+        data = {}
+        if path is not None:
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except FileNotFoundError:
+                pass
+        self.steps = data.get('steps', {})
+        self.vars = data.get('vars', {})
+
+    def is_done(self, step):
+        record = self.steps.get(step.name)
+        if record is None:
+            return False
+        return (record['inputs'] == _hash_files(step.inputs)
+                and record['outputs'] == _hash_files(step.outputs))
+
+    def mark_done(self, step, inputs_hash):
+        self.steps[step.name] = {
+            'inputs': inputs_hash,
+            'outputs': _hash_files(step.outputs),
+        }
+        self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        write_file(self.path, json.dumps(
+            {'steps': self.steps, 'vars': self.vars}, indent=2))
+
+
+def add_step_args(parser, steps):
+    names = [step.name for step in steps]
+    parser.add_argument('-r', '--resume', action='store_true',
+            help="skip the steps that are already done")
+    parser.add_argument('--only', nargs='+', choices=names, metavar='STEP',
+            help="run only these steps, one of: " + ', '.join(names))
+    parser.add_argument('--skip', nargs='+', choices=names, default=[],
+            metavar='STEP', help="do not run these steps")
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+            help="number of steps run at the same time")
+
+def select_steps(steps, args):
+    selected = []
+    for step in steps:
+        if args.only is not None and step.name not in args.only:
+            continue
+        if step.name in args.skip:
+            continue
+        selected.append(step)
+    return selected
+
+def _check_deps(steps):
+    names = {step.name for step in steps}
+    order = {}
+    for i, step in enumerate(steps):
+        for dep in step.deps:
+            # steps not selected count as done
+            if dep in names and order.get(dep) is None:
+                raise ValueError("{} depends on {}, which is not before "
+                        "it".format(step.name, dep))
+        order[step.name] = i
+
+def run_steps(steps, state, resume=False, on_done=None, max_workers=4):
+    """Run steps, recording each one in state.
+
+    The early steps with nothing to wait for are started first, then the
+    prompts of the steps are asked, in order. Then a step is started as
+    soon as the steps it depends on are done, at most max_workers at a
+    time; an interactive step waits for the running ones and runs alone. A
+    dependency which is not in steps counts as done. If a step fails, no
+    new step is started and the error is raised once the running ones are
+    finished.
+
+    on_done is called after every step, in the calling thread, e.g. to
+    save variables to state.vars before the state is written.
+    """
+    _check_deps(steps)
+    pending = []
+    for step in steps:
+        if resume and state.is_done(step):
+            print("Skipping {} (already done).".format(step.name))
+            continue
+        pending.append(step)
+    pending_names = {step.name for step in pending}
+    answers = {}
+
+    def _ready(step):
+        return not any(dep in pending_names and dep not in done
+                for dep in step.deps)
+
+    def _run(step):
+        inputs_hash = _hash_files(step.inputs)
+        with TIMELINE.span(step.name):
+            if step.prompt is not None:
+                step.f(answers[step.name])
+            else:
+                step.f()
+        return inputs_hash
+
+    def _finish(step, inputs_hash):
+        done.add(step.name)
+        if on_done is not None:
+            on_done(step)
+        state.mark_done(step, inputs_hash)
+
+    done = set()
+    running = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for step in list(pending):
+            if (step.early and step.prompt is None and not step.interactive
+                    and _ready(step) and len(running) < max_workers):
+                pending.remove(step)
+                running[pool.submit(_run, step)] = step
+
+        try:
+            for step in pending:
+                if step.prompt is not None:
+                    answers[step.name] = step.prompt()
+        except BaseException:
+            # e.g. Ctrl-C or EOF, do not wait for a long download
+            pool.shutdown(wait=False, cancel_futures=True)
+            stop_commands()
+            raise
+
+        while pending or running:
+            if error is None:
+                for step in list(pending):
+                    if not _ready(step):
+                        continue
+                    if step.interactive:
+                        # later steps wait, so that it is not delayed
+                        if not running:
+                            pending.remove(step)
+                            try:
+                                _finish(step, _run(step))
+                            except Exception as e:
+                                error = e
+                        break
+                    if len(running) >= max_workers:
+                        break
+                    pending.remove(step)
+                    running[pool.submit(_run, step)] = step
+            if error is not None:
+                pending = []
+            if not running:
+                if pending and error is None:
+                    continue
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                try:
+                    _finish(step, future.result())
+                except Exception as e:
+                    if error is None:
+                        error = e
+    if error is not None:
+        raise error
@@ -0,0 +1,206 @@
+"""Plan swap from the installed RAM: zram, zswap and a disk swapfile.
+
+Compressed RAM is much faster than any disk, so when it is used the disk
+swapfile gets a lower priority (zram) or sits behind the zswap cache,
+and the kernel is told to swap more eagerly than for a disk-only setup.
+
+Modes:
+    disk        a swapfile only
+    zram        a compressed RAM block device only
+    zram+disk   zram first, the swapfile when zram is full
+    zswap       a swapfile with a compressed cache in front of it
+"""
+import os
+import re
+
+from _utils import write_file
+from _sysctl import update_conf
+
+
+GiB = 1024 ** 3
+
+MODES = ['disk', 'zram', 'zram+disk', 'zswap']
+
+# zram and disk are fractions of RAM, bounded by the min/max sizes
+PROFILES = {
+    'desktop': {
+        'zram': 0.5, 'zram_max': 16 * GiB,
+        'disk': 0.5, 'disk_min': 2 * GiB, 'disk_max': 16 * GiB,
+        'algorithm': 'zstd',
+    },
+    # latency matters more than the compression ratio
+    'server': {
+        'zram': 0.25, 'zram_max': 8 * GiB,
+        'disk': 0.25, 'disk_min': 1 * GiB, 'disk_max': 8 * GiB,
+        'algorithm': 'lz4',
+    },
+    # little RAM, compress as much as possible
+    'small': {
+        'zram': 1.0, 'zram_max': 8 * GiB,
+        'disk': 1.0, 'disk_min': 2 * GiB, 'disk_max': 8 * GiB,
+        'algorithm': 'zstd',
+    },
+}
+
+ZRAM_PRIORITY = 100
+DISK_PRIORITY = 10
+ZSWAP_MAX_POOL_PERCENT = 20
+
+SYSCTL = {
+    'disk': {
+        'vm.swappiness': 5,
+    },
+    # swapping to RAM is cheap; readahead is useless for it
+    'zram': {
+        'vm.swappiness': 180,
+        'vm.page-cluster': 0,
+        'vm.watermark_boost_factor': 0,
+        'vm.watermark_scale_factor': 125,
+    },
+    'zswap': {
+        'vm.swappiness': 100,
+    },
+}
+SYSCTL['zram+disk'] = SYSCTL['zram']
+
+ZRAM_MODULES_FILE = 'etc/modules-load.d/zram.conf'
+ZRAM_UDEV_FILE = 'etc/udev/rules.d/99-zram.rules'
+ZSWAP_TMPFILES_FILE = 'etc/tmpfiles.d/zswap.conf'
+# a drop-in of its own, not to change the 99-sysctl.conf of the configs,
+# sorting after it so that its values win
+SYSCTL_FILE = 'etc/sysctl.d/99-zz-swap.conf'
+
+
+def total_ram():
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1]) * 1024
+    raise OSError("MemTotal not found in /proc/meminfo")
+
+def format_size(size):
+    """In the format of fallocate and zram, e.g. '512M'."""
+    mib = max(size // 2**20, 1)
+    if mib % 1024 == 0:
+        return '{}G'.format(mib // 1024)
+    return '{}M'.format(mib)
+
+def parse_size(size):
+    match = re.match(r'^(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?$', size.strip(), re.I)
+    if not match:
+        raise ValueError("bad size {!r}".format(size))
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** 'BKMGT'.index(unit.upper() or 'B'))
+
+
+class SwapPlan:
+    def __init__(self, mode, profile, ram, zram_size=0, disk_size=0,
+            algorithm='zstd'):
+        self.mode = mode
+        self.profile = profile
+        self.ram = ram
+        self.zram_size = zram_size
+        self.disk_size = disk_size
+        self.algorithm = algorithm
+
+    @property
+    def sysctl(self):
+        return SYSCTL[self.mode]
+
+    def kernel_params(self):
+        """zswap can also be enabled at boot with these."""
+        if self.mode != 'zswap':
+            return []
+        return ['zswap.enabled=1', 'zswap.compressor=' + self.algorithm,
+                'zswap.max_pool_percent={}'.format(ZSWAP_MAX_POOL_PERCENT)]
+
+    def describe(self):
+        lines = ["mode {}, profile {}, RAM {}".format(
+            self.mode, self.profile, format_size(self.ram))]
+        if self.zram_size:
+            lines.append("zram {} ({}, priority {})".format(
+                format_size(self.zram_size), self.algorithm, ZRAM_PRIORITY))
+        if self.mode == 'zswap':
+            lines.append("zswap {}, at most {}% of RAM".format(
+                self.algorithm, ZSWAP_MAX_POOL_PERCENT))
+        if self.disk_size:
+            lines.append("swapfile {} (priority {})".format(
+                format_size(self.disk_size),
+                DISK_PRIORITY if self.mode != 'disk' else 'default'))
+        lines.append(', '.join('{} = {}'.format(k, v)
+            for k, v in self.sysctl.items()))
+        return lines
+
+
+def plan_swap(mode, profile='desktop', ram=None):
+    if mode not in MODES:
+        raise ValueError("unknown mode {}".format(mode))
+    p = PROFILES[profile]
+    ram = ram or total_ram()
+    plan = SwapPlan(mode, profile, ram, algorithm=p['algorithm'])
+    if mode in ('zram', 'zram+disk'):
+        plan.zram_size = min(int(ram * p['zram']), p['zram_max'])
+    if mode in ('disk', 'zram+disk', 'zswap'):
+        size = int(ram * p['disk'])
+        plan.disk_size = max(min(size, p['disk_max']), p['disk_min'])
+    return plan
+
+
+def zram_udev_rule(plan):
+    return ('ACTION=="add", KERNEL=="zram0", '
+            'ATTR{{comp_algorithm}}="{}", ATTR{{disksize}}="{}", '
+            'RUN="/usr/bin/mkswap -U clear /dev/%k", TAG+="systemd"\n').format(
+                plan.algorithm, format_size(plan.zram_size))
+
+def zswap_tmpfiles(plan):
+    lines = ['w /sys/module/zswap/parameters/{} - - - - {}'.format(k, v)
+            for k, v in [('compressor', plan.algorithm),
+                ('max_pool_percent', ZSWAP_MAX_POOL_PERCENT),
+                ('enabled', 1)]]
+    return '\n'.join(lines) + '\n'
+
+def fstab_lines(plan, swap_file):
+    """swap_file is the path inside of the target system."""
+    lines = []
+    if plan.zram_size:
+        lines.append('/dev/zram0 none swap defaults,pri={} 0 0'.format(
+            ZRAM_PRIORITY))
+    if plan.disk_size:
+        options = 'defaults'
+        if plan.mode != 'disk':
+            options += ',pri={}'.format(DISK_PRIORITY)
+        lines.append('{} none swap {} 0 0'.format(swap_file, options))
+    return lines
+
+def write_config(plan, root, swap_file):
+    """Write the config files of plan into the system at root."""
+    def _path(rel):
+        path = os.path.join(root, rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    if plan.zram_size:
+        write_file(_path(ZRAM_MODULES_FILE), 'zram\n')
+        write_file(_path(ZRAM_UDEV_FILE), zram_udev_rule(plan))
+    if plan.mode == 'zswap':
+        write_file(_path(ZSWAP_TMPFILES_FILE), zswap_tmpfiles(plan))
+
+    fstab = _path('etc/fstab')
+    with open(fstab) as f:
+        text = f.read()
+    # not twice when re-run
+    existing = {line.split()[0] for line in text.splitlines()
+            if line.strip() and not line.lstrip().startswith('#')}
+    new = [line for line in fstab_lines(plan, swap_file)
+            if line.split()[0] not in existing]
+    if new:
+        write_file(fstab, text + ''.join(line + '\n' for line in new))
+
+    sysctl = _path(SYSCTL_FILE)
+    try:
+        with open(sysctl) as f:
+            text = f.read()
+    except FileNotFoundError:
+        text = ''
+    write_file(sysctl, update_conf(text, plan.sysctl,
+        comment='swap settings, see _swap.py'))
@@ -0,0 +1,55 @@
+"""Read and write sysctl values, in /proc/sys and in sysctl.conf files."""
+import os
+import re
+
+
+SYSCTL_CONF_FILE = '/etc/sysctl.d/99-sysctl.conf'
+
+SYSCTL_RE = re.compile(r'^\s*([\w.-]+)\s*=\s*(.*?)\s*$')
+
+
+def _proc_path(key):
+    return os.path.join('/proc/sys', key.replace('.', '/'))
+
+def read(key):
+    with open(_proc_path(key)) as f:
+        return f.read().strip()
+
+def write(key, value):
+    with open(_proc_path(key), 'w') as f:
+        f.write(str(value))
+
+def parse_conf(text):
+    """Returns {key: value} of the text of a sysctl.conf."""
+    values = {}
+    for line in text.splitlines():
+        match = SYSCTL_RE.match(line)
+        if match and not line.lstrip().startswith(('#', ';')):
+            values[match.group(1)] = match.group(2)
+    return values
+
+def update_conf(text, values, remove=(), comment=None):
+    """Set values in the text of a sysctl.conf, keeping everything else.
+
+    The keys in remove are commented out. New keys are appended, after
+    comment if given.
+    """
+    values = dict(values)
+    lines = text.splitlines()
+    for i, line in enumerate(lines):
+        match = SYSCTL_RE.match(line)
+        if not match or line.lstrip().startswith(('#', ';')):
+            continue
+        key = match.group(1)
+        if key in values:
+            lines[i] = '{} = {}'.format(key, values.pop(key))
+        elif key in remove:
+            lines[i] = '#' + line
+    if values:
+        # a blank line after the existing text, not at the top of a new file
+        if lines:
+            lines.append('')
+        if comment:
+            lines.append('# ' + comment)
+        lines += ['{} = {}'.format(k, v) for k, v in values.items()]
+    return '\n'.join(lines) + '\n'
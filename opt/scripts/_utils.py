@@ -1,7 +1,29 @@
 import pwd
 import subprocess
 import os
-from multiprocessing import Process
+import sys
+import json
+import atexit
+import shutil
+import ctypes
+import errno
+import fcntl
+import pty
+import termios
+import resource
+import threading
+import traceback
+import multiprocessing
+from time import monotonic, time
+from contextlib import contextmanager
+
+
+# the scripts do `from _utils import *`
+__all__ = [
+    'get_user_info', 'Event', 'Timeline', 'TIMELINE', 'stop_commands',
+    'UserWorker', 'get_user_worker', 'call_f_as_user', 'run_as_user', 'run',
+    'syncfs', 'fsync_dir', 'write_file', 'AtomicWrites',
+]
 
 
 def get_user_info(user_name):
@@ -16,36 +38,431 @@ def _change_user(uid, gid):
         os.setgid(gid)
         os.setuid(uid)
 
-def call_f_as_user(user_name, f, args=(), kwargs={}, cwd=None):
-    """Call function as another user.
+class Event:
+    """A command, function call or step on the timeline."""
+    def __init__(self, name, cat, start, end, returncode=None, user=None,
+            cpu_user=None, cpu_sys=None, maxrss=None, tid=None):
+        self.name = name
+        self.cat = cat
+        self.start = start
+        self.end = end
+        self.returncode = returncode
+        self.user = user
+        self.cpu_user = cpu_user
+        self.cpu_sys = cpu_sys
+        # KiB, from wait4, so never less than the rss of the python process
+        # the command was forked from (over 10 MiB, even for `true`)
+        self.maxrss = maxrss
+        self.tid = tid if tid is not None else threading.get_ident()
 
-    By default, cwd is set to the home dir of the 
-    run-as user.
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def describe(self):
+        parts = ["{:.1f} s".format(self.duration)]
+        if self.cpu_user is not None:
+            parts.append("cpu {:.1f} s".format(self.cpu_user + self.cpu_sys))
+        if self.maxrss:
+            parts.append("rss {:.0f} MiB".format(self.maxrss / 1024))
+        if self.returncode:
+            parts.append("exit {}".format(self.returncode))
+        return "{}: {}".format(self.name, ', '.join(parts))
+
+
+class Timeline:
+    """Records what run, run_as_user and call_f_as_user do.
+
+    The events can be exported in the Chrome trace format (open it in
+    chrome://tracing or https://ui.perfetto.dev). If a log file is set,
+    the commands are printed, and their output is also written to it.
+    The peak rss of a command includes that of the forked python process,
+    see Event.
     """
-    if os.geteuid() != 0:
-        raise OSError("You're not root, cannot run "
-                "function as other user.")
-    uid, gid, user_home = get_user_info(user_name)
+    def __init__(self):
+        self.events = []
+        self.start = monotonic()
+        self.log = None
+        self._lock = threading.Lock()
 
-    if cwd is not None:
-        cwd = os.path.abspath(cwd)
+    def add(self, event):
+        with self._lock:
+            self.events.append(event)
+
+    def set_log(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.log = open(path, 'a', buffering=1, errors='replace')
+
+    def write_log(self, text):
+        if self.log is not None:
+            with self._lock:
+                self.log.write(text)
+
+    @contextmanager
+    def span(self, name, cat='step'):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.add(Event(name, cat, start, monotonic()))
+
+    def chrome_trace(self):
+        tids = {}
+        events = []
+        for e in sorted(self.events, key=lambda e: e.start):
+            args = {k: v for k, v in [('user', e.user),
+                ('exit', e.returncode), ('cpu_user', e.cpu_user),
+                ('cpu_sys', e.cpu_sys), ('maxrss_kib', e.maxrss)]
+                if v is not None}
+            events.append({
+                'name': e.name, 'cat': e.cat, 'ph': 'X',
+                'ts': int((e.start - self.start) * 1e6),
+                'dur': int(e.duration * 1e6),
+                'pid': os.getpid(),
+                'tid': tids.setdefault(e.tid, len(tids)),
+                'args': args,
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': {'maxrss_kib': "peak rss from wait4, which "
+                    "includes the python process the command was forked "
+                    "from"}}
+
+    def write_trace(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_file(path, json.dumps(self.chrome_trace()), sync=False)
+
+    def summary(self, n=10):
+        lines = []
+        for cat, title in [('step', 'steps'), ('command', 'commands')]:
+            events = sorted((e for e in self.events if e.cat == cat),
+                    key=lambda e: e.duration, reverse=True)[:n]
+            if events:
+                lines.append("Slowest {}:".format(title))
+                lines += ["\t" + e.describe() for e in events]
+        return lines
+
+    def report(self, trace_file, n=10):
+        """Write the trace and print the summary, e.g. at exit."""
+        for line in self.summary(n):
+            print(line)
+        self.write_trace(trace_file)
+        print("Timeline written to {}.".format(trace_file))
 
-    def _f():
-        _change_user(uid, gid)
-        os.environ['HOME'] = user_home
-        os.environ['LOGNAME'] = user_name
-        os.environ['USER'] = user_name
-        if cwd is not None:
-            os.chdir(cwd)
-            os.environ['PWD'] = cwd
-        else:
-            os.chdir(user_home)
-            os.environ['PWD'] = user_home
-        f(*args, **kwargs)
 
-    p = Process(target=_f)
-    p.start()
-    p.join()
+TIMELINE = Timeline()
+
+# how long to wait for the output after a command exits
+TEE_TIMEOUT = 1
+
+# the commands being run, so that another thread can stop them
+_running = set()
+_running_lock = threading.Lock()
+_stopped = False
+
+def stop_commands():
+    """Terminate the commands started by run(), and any started later.
+
+    For giving up, e.g. on Ctrl-C while other threads run commands.
+    """
+    global _stopped
+    with _running_lock:
+        _stopped = True
+        for p in _running:
+            # a no-op if it has just exited
+            p.terminate()
+
+def _log_line(line):
+    # only the last state of a line redrawn with \r, e.g. a progress bar,
+    # and a pty ends lines with \r\n
+    return line.rstrip(b'\r').rsplit(b'\r', 1)[-1].decode(errors='replace')
+
+def _tee(pipe, out, pid):
+    """Copy pipe to the fd out (if not None) as it comes, and by lines to
+    the log."""
+    partial = b''
+    while True:
+        try:
+            data = os.read(pipe.fileno(), 65536)
+        except OSError as e:
+            # a pty whose other end is closed
+            if e.errno != errno.EIO:
+                raise
+            data = b''
+        if not data:
+            break
+        if out is not None:
+            os.write(out, data)
+        lines = (partial + data).split(b'\n')
+        partial = lines.pop()
+        TIMELINE.write_log(''.join('[{}] {}\n'.format(pid, _log_line(line))
+            for line in lines))
+    if partial:
+        TIMELINE.write_log('[{}] {}\n'.format(pid, _log_line(partial)))
+    pipe.close()
+
+def _cmdline(cmd):
+    if isinstance(cmd, str):
+        return cmd
+    return ' '.join(str(arg) for arg in cmd)
+
+def _open_pty(like_fd):
+    """Returns (master, slave) of a new pty, sized like the tty like_fd."""
+    master, slave = pty.openpty()
+    try:
+        size = fcntl.ioctl(like_fd, termios.TIOCGWINSZ, b'\0' * 8)
+        fcntl.ioctl(slave, termios.TIOCSWINSZ, size)
+    except OSError:
+        pass
+    return master, slave
+
+def _run_traced(cmd, as_user=None, capture=True, input=None, quiet=False,
+        **kwargs):
+    """check_call, recording the command on TIMELINE.
+
+    With a log file set, stdout and stderr are copied to it (unless given
+    in kwargs, or capture is False, e.g. for an interactive shell). When
+    stdout is a terminal, the command gets a pty instead of pipes, so that
+    its progress bars, colours and prompts still work. input
+    (a str, e.g. a password) is written to stdin, and not logged. With
+    quiet, the output only goes to the log, e.g. for a command running in
+    the background while questions are asked.
+    """
+    capture = capture and TIMELINE.log is not None
+    streams = []
+    tty = None
+    if (capture and not quiet and sys.stdout.isatty()
+            and 'stdout' not in kwargs and 'stderr' not in kwargs):
+        master, tty = _open_pty(sys.stdout.fileno())
+        kwargs['stdout'] = kwargs['stderr'] = tty
+    elif capture:
+        for name, fd in [('stdout', sys.stdout.fileno()),
+                ('stderr', sys.stderr.fileno())]:
+            if name not in kwargs:
+                kwargs[name] = subprocess.PIPE
+                streams.append((name, None if quiet else fd))
+    elif quiet:
+        kwargs.setdefault('stdout', subprocess.DEVNULL)
+        kwargs.setdefault('stderr', subprocess.DEVNULL)
+    if TIMELINE.log is not None:
+        cmdline = _cmdline(cmd)
+        if not quiet:
+            print("\t$ {}".format(cmdline))
+        TIMELINE.write_log("$ {}{}\n".format(cmdline,
+            ' (as {})'.format(as_user) if as_user else ''))
+        sys.stdout.flush()
+
+    if input is not None:
+        kwargs['stdin'] = subprocess.PIPE
+        kwargs['universal_newlines'] = True
+
+    start = monotonic()
+    try:
+        p = subprocess.Popen(cmd, **kwargs)
+    except BaseException:
+        if tty is not None:
+            os.close(master)
+        raise
+    finally:
+        if tty is not None:
+            # only the child keeps it open, so that the master sees EOF
+            os.close(tty)
+    with _running_lock:
+        _running.add(p)
+        if _stopped:
+            p.terminate()
+    if input is not None:
+        # small, fits in the pipe
+        p.stdin.write(input)
+        p.stdin.close()
+    pipes = [(getattr(p, name), fd) for name, fd in streams]
+    if tty is not None:
+        pipes.append((open(master, 'rb', buffering=0), sys.stdout.fileno()))
+    tees = [threading.Thread(target=_tee, args=(pipe, fd, p.pid),
+                daemon=True) for pipe, fd in pipes]
+    for t in tees:
+        t.start()
+    try:
+        # not p.wait(), to get the resource usage of the child
+        _, status, usage = os.wait4(p.pid, 0)
+        end = monotonic()
+    except BaseException:
+        p.kill()
+        p.wait()
+        raise
+    finally:
+        with _running_lock:
+            _running.discard(p)
+        # a daemon started by the command may keep the pipes open
+        deadline = monotonic() + TEE_TIMEOUT
+        for t in tees:
+            t.join(max(deadline - monotonic(), 0))
+    p.returncode = os.waitstatus_to_exitcode(status)
+    TIMELINE.add(Event(_cmdline(cmd), 'command', start, end,
+        p.returncode, as_user, usage.ru_utime, usage.ru_stime,
+        usage.ru_maxrss))
+    if p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+    return p.returncode
+
+def _cpu_times():
+    self_ = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (self_.ru_utime + children.ru_utime,
+            self_.ru_stime + children.ru_stime)
+
+# of the trace events of function calls, whose arguments may be long
+MAX_CALL_NAME = 100
+
+def _call_name(f, args):
+    if f is subprocess.check_call and args:
+        return _cmdline(args[0]), 'command'
+    name = '{}{}'.format(getattr(f, '__name__', f), tuple(args))
+    if len(name) > MAX_CALL_NAME:
+        name = name[:MAX_CALL_NAME - 3] + '...'
+    return name, 'function'
+
+
+class UserWorker:
+    """A long-lived process running functions as another user.
+
+    Privileges are dropped once, when the worker starts. Functions (and
+    their arguments and results) are sent over a pipe, so they must be
+    picklable, e.g. module level functions. Exceptions raised in the
+    worker are re-raised in the caller.
+
+    The worker is forked when it is created, so functions see the module
+    globals as they were then, e.g. not a variable set by a later prompt:
+    pass them everything they need as arguments. Create it (see
+    get_user_worker) before starting any thread, since a fork can
+    deadlock on a lock held by another thread.
+    """
+    def __init__(self, user_name):
+        if os.geteuid() != 0:
+            raise OSError("You're not root, cannot run "
+                    "function as other user.")
+        self.user_name = user_name
+        self.uid, self.gid, self.user_home = get_user_info(user_name)
+
+        # fork, so that nothing has to be re-imported in the worker
+        ctx = multiprocessing.get_context('fork')
+        self._conn, child_conn = ctx.Pipe()
+        self._process = ctx.Process(target=self._serve, args=(child_conn,),
+                daemon=True)
+        self._process.start()
+        child_conn.close()
+
+    def _serve(self, conn):
+        self._conn.close()
+        _change_user(self.uid, self.gid)
+        os.environ['HOME'] = self.user_home
+        os.environ['LOGNAME'] = self.user_name
+        os.environ['USER'] = self.user_name
+        while True:
+            try:
+                calls = conn.recv()
+            except EOFError:
+                break
+            if calls is None:
+                break
+            for f, args, kwargs, cwd in calls:
+                start = monotonic()
+                cpu = _cpu_times()
+                try:
+                    cwd = cwd if cwd is not None else self.user_home
+                    os.chdir(cwd)
+                    os.environ['PWD'] = cwd
+                    ok, value = True, f(*args, **kwargs)
+                except BaseException as e:
+                    ok, value = False, (e, traceback.format_exc())
+                # the worker runs one call at a time, so the difference
+                # is the cpu time of this call and its children
+                usage = (start, monotonic(),
+                        *(b - a for a, b in zip(cpu, _cpu_times())))
+                try:
+                    conn.send((ok, value, usage))
+                except Exception:
+                    # not picklable
+                    e, tb = value if not ok else (value, '')
+                    conn.send((False, (RuntimeError(repr(e)), tb), usage))
+
+    def batch(self, calls):
+        """Run a list of (f, args, kwargs, cwd) tuples in order.
+
+        All calls are run even if some of them fail. Returns the list of
+        results, or raises the first exception.
+        """
+        calls = [(f, args, kwargs, os.path.abspath(cwd)
+                if cwd is not None else None)
+                for f, args, kwargs, cwd in calls]
+        self._conn.send(calls)
+        results = []
+        error = None
+        tid = threading.get_ident()
+        for f, args, _, _ in calls:
+            ok, value, (start, end, cpu_user, cpu_sys) = self._conn.recv()
+            name, cat = _call_name(f, args)
+            returncode = None if ok else getattr(value[0], 'returncode', 1)
+            TIMELINE.add(Event(name, cat, start, end, returncode,
+                self.user_name, cpu_user, cpu_sys, tid=tid))
+            if ok:
+                results.append(value)
+            else:
+                e, tb = value
+                results.append(e)
+                if error is None:
+                    error = e
+                    error.remote_traceback = tb
+        if error is not None:
+            raise error
+        return results
+
+    def call(self, f, args=(), kwargs={}, cwd=None):
+        return self.batch([(f, args, kwargs, cwd)])[0]
+
+    def run(self, cmd, cwd=None, **kwargs):
+        return self.call(subprocess.check_call, (cmd,), kwargs, cwd)
+
+    def close(self):
+        if self._process.is_alive():
+            try:
+                self._conn.send(None)
+            except OSError:
+                pass
+        self._conn.close()
+        self._process.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_user_workers = {}
+
+def get_user_worker(user_name):
+    """Return the shared worker of a user, starting it if needed."""
+    worker = _user_workers.get(user_name)
+    if worker is None or not worker._process.is_alive():
+        worker = UserWorker(user_name)
+        _user_workers[user_name] = worker
+    return worker
+
+@atexit.register
+def _close_user_workers():
+    for worker in _user_workers.values():
+        worker.close()
+    _user_workers.clear()
+
+def call_f_as_user(user_name, f, args=(), kwargs={}, cwd=None):
+    """Call function as another user.
+
+    By default, cwd is set to the home dir of the 
+    run-as user. The call is made in the shared worker of
+    the user, which is started on first use unless started
+    before, see UserWorker.
+    """
+    return get_user_worker(user_name).call(f, args, kwargs, cwd)
 
 def run_as_user(user_name, cmd, cwd=None, **kwargs):
     """Run command as another user.
@@ -71,12 +488,141 @@ def run_as_user(user_name, cmd, cwd=None, **kwargs):
         cwd = os.path.abspath(cwd)
         env['PWD'] = cwd
 
-    def _preexec():
-        _change_user(uid, gid)
+    # not preexec_fn, so that this can be called from several threads
+    _run_traced(cmd, as_user=user_name, cwd=cwd, env=env,
+        user=uid, group=gid, extra_groups=[], **kwargs)
+
+def run(cmd, **kwargs):
+    """check_call, recorded on TIMELINE, see _run_traced."""
+    _run_traced(cmd, **kwargs)
+
+
 
-    subprocess.check_call(cmd, cwd=cwd, env=env,
-        preexec_fn=_preexec, **kwargs)
+_libc = None
 
-def run(*args, **kwargs):
-    subprocess.check_call(*args, **kwargs)
+def syncfs(path):
+    """Flush the filesystem containing path.
 
+    Unlike sync(1), the other filesystems are not waited for.
+    """
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if _libc.syncfs(fd) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+    finally:
+        os.close(fd)
+
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _tmp_path(path):
+    return os.path.join(os.path.dirname(path) or '.',
+            '.{}.tmp'.format(os.path.basename(path)))
+
+def _write_tmp(path, data):
+    tmp = _tmp_path(path)
+    with open(tmp, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+    return tmp
+
+def _copy_tmp(src, path):
+    tmp = _tmp_path(path)
+    shutil.copyfile(src, tmp)
+    return tmp
+
+def _replace(tmp, path, backup):
+    if os.path.exists(path):
+        if backup:
+            shutil.copy2(path, path + '.bak')
+        try:
+            shutil.copymode(path, tmp)
+        except OSError:
+            # e.g. vfat
+            pass
+    os.replace(tmp, path)
+
+def write_file(path, data, backup=False, sync=True):
+    """Replace path with data (str or bytes) atomically.
+
+    The data is written to a temporary file next to path, which is renamed
+    over it, so readers see either the old or the new content. The mode of
+    the old file is kept, and it is saved to path.bak if backup is set.
+    With sync, the file and its directory are fsynced before returning.
+    """
+    tmp = _write_tmp(path, data)
+    try:
+        if sync:
+            with open(tmp, 'rb') as f:
+                os.fsync(f.fileno())
+        _replace(tmp, path, backup)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    if sync:
+        fsync_dir(os.path.dirname(path) or '.')
+
+class AtomicWrites:
+    """Write or copy several files, and commit them together.
+
+    Files are staged under temporary names next to their targets. On
+    commit, the affected filesystems are flushed with syncfs, the files
+    are renamed in place, and the filesystems are flushed again, so that
+    the renames are durable too. That is two syncfs per filesystem, not an
+    fsync per file, and unrelated filesystems are never waited for.
+
+    Used as a context manager, the files are committed when the block
+    ends, or discarded if it raises.
+    """
+    def __init__(self, backup=False, sync=True):
+        self.backup = backup
+        self.sync = sync
+        self._pending = []
+
+    def write(self, path, data):
+        self._pending.append((_write_tmp(path, data), path))
+
+    def copy(self, src, path):
+        self._pending.append((_copy_tmp(src, path), path))
+
+    def _sync(self, pending):
+        devices = {}
+        for tmp, _ in pending:
+            devices.setdefault(os.stat(tmp).st_dev, tmp)
+        for tmp in devices.values():
+            syncfs(os.path.dirname(tmp) or '.')
+
+    def commit(self):
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        if self.sync:
+            self._sync(pending)
+        for tmp, path in pending:
+            _replace(tmp, path, self.backup)
+        if self.sync:
+            # the targets are on the same filesystems as the temporary files
+            self._sync([(path, None) for _, path in pending])
+
+    def abort(self):
+        pending, self._pending = self._pending, []
+        for tmp, _ in pending:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""Benchmark writeback sysctl profiles, and generate one for this machine.
+
+The same workload is run once per candidate profile, in a directory on
+the filesystem to test (to test a bare disk or a loop device, make a
+filesystem on it and mount it first):
+
+    - a bulk writer writes BULK_SIZE sequentially without fsync, the
+      throughput is measured up to the final fsync
+    - meanwhile, small writes are fsynced to another file every
+      FSYNC_INTERVAL, the latency of each fsync is measured
+    - and 4 KiB blocks are read from a third, uncached file
+
+The data and offsets come from a fixed seed, and the page cache is
+dropped before every run, so runs are comparable. The candidates are the
+kernel defaults, the current /etc/sysctl.d/99-sysctl.conf, any sysctl
+files given with --profile, and a profile generated from the RAM size and
+the best measured throughput. The original values are restored at the
+end.
+
+The generated profile sizes the dirty limits in bytes when a percentage
+of the RAM is too coarse a unit (e.g. 1% of 64 GiB is 640 MiB).
+"""
+import sys
+import os
+import random
+import threading
+from time import monotonic
+
+import _sysctl
+from _sysctl import SYSCTL_CONF_FILE, parse_conf, update_conf
+from _swap import total_ram, format_size, parse_size
+from _utils import run, write_file
+
+
+MiB = 1024 ** 2
+GiB = 1024 ** 3
+
+BLOCK_SIZE = 4096
+CHUNK_SIZE = MiB
+SMALL_FILE_SIZE = 64 * MiB
+READ_FILE_SIZE = 256 * MiB
+FSYNC_INTERVAL = 0.01
+SEED = 42
+
+WRITEBACK_KEYS = [
+    'vm.dirty_ratio',
+    'vm.dirty_bytes',
+    'vm.dirty_background_ratio',
+    'vm.dirty_background_bytes',
+    'vm.dirty_expire_centisecs',
+    'vm.dirty_writeback_centisecs',
+    'vm.vfs_cache_pressure',
+]
+# setting one of a pair resets the other to 0
+COUNTERPARTS = {
+    'vm.dirty_ratio': 'vm.dirty_bytes',
+    'vm.dirty_bytes': 'vm.dirty_ratio',
+    'vm.dirty_background_ratio': 'vm.dirty_background_bytes',
+    'vm.dirty_background_bytes': 'vm.dirty_background_ratio',
+}
+
+KERNEL_DEFAULTS = {
+    'vm.dirty_ratio': 20,
+    'vm.dirty_background_ratio': 10,
+    'vm.dirty_expire_centisecs': 3000,
+    'vm.dirty_writeback_centisecs': 500,
+    'vm.vfs_cache_pressure': 100,
+}
+
+# bounds of the generated dirty_background_bytes
+MIN_BACKGROUND_BYTES = 16 * MiB
+MAX_BACKGROUND_FRACTION = 0.05
+# dirty_bytes relative to dirty_background_bytes, and its upper bound
+DIRTY_FACTOR = 4
+MAX_DIRTY_FRACTION = 0.12
+
+
+def percentile(values, p):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(int(p * len(values)), len(values) - 1)]
+
+
+class Result:
+    def __init__(self, name, throughput, fsyncs, reads):
+        self.name = name
+        self.throughput = throughput
+        self.fsyncs = fsyncs
+        self.reads = reads
+
+    def describe(self):
+        return ("{:.0f} MiB/s, fsync p50 {:.1f} ms p99 {:.1f} ms "
+                "max {:.1f} ms, read p99 {:.1f} ms").format(
+                    self.throughput / MiB,
+                    percentile(self.fsyncs, 0.5) * 1000,
+                    percentile(self.fsyncs, 0.99) * 1000,
+                    max(self.fsyncs, default=float('nan')) * 1000,
+                    percentile(self.reads, 0.99) * 1000)
+
+
+class Workload:
+    def __init__(self, dir_, bulk_size, seed=SEED,
+            fsync_interval=FSYNC_INTERVAL):
+        self.dir = dir_
+        self.bulk_size = bulk_size
+        self.seed = seed
+        self.fsync_interval = fsync_interval
+        self.bulk_file = os.path.join(dir_, 'bench_writeback.bulk')
+        self.small_file = os.path.join(dir_, 'bench_writeback.small')
+        self.read_file = os.path.join(dir_, 'bench_writeback.read')
+        self.chunk = random.Random(seed).randbytes(CHUNK_SIZE)
+
+    def prepare(self):
+        print("Preparing the files in {}...".format(self.dir))
+        for path, size in [(self.read_file, READ_FILE_SIZE),
+                (self.small_file, SMALL_FILE_SIZE)]:
+            with open(path, 'wb') as f:
+                for _ in range(size // CHUNK_SIZE):
+                    f.write(self.chunk)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def cleanup(self):
+        for path in [self.bulk_file, self.small_file, self.read_file]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _fsync_loop(self, stop, latencies):
+        rng = random.Random(self.seed + 1)
+        block = self.chunk[:BLOCK_SIZE]
+        fd = os.open(self.small_file, os.O_WRONLY)
+        try:
+            while not stop.is_set():
+                offset = rng.randrange(SMALL_FILE_SIZE // BLOCK_SIZE)
+                os.pwrite(fd, block, offset * BLOCK_SIZE)
+                start = monotonic()
+                os.fsync(fd)
+                latencies.append(monotonic() - start)
+                stop.wait(self.fsync_interval)
+        finally:
+            os.close(fd)
+
+    def _read_loop(self, stop, latencies):
+        rng = random.Random(self.seed + 2)
+        fd = os.open(self.read_file, os.O_RDONLY)
+        try:
+            while not stop.is_set():
+                offset = rng.randrange(READ_FILE_SIZE // BLOCK_SIZE)
+                start = monotonic()
+                os.pread(fd, BLOCK_SIZE, offset * BLOCK_SIZE)
+                latencies.append(monotonic() - start)
+                stop.wait(self.fsync_interval)
+        finally:
+            os.close(fd)
+
+    def run(self, name):
+        # the same starting point for every profile
+        run(['sync'])
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3')
+
+        stop = threading.Event()
+        fsyncs, reads = [], []
+        threads = [threading.Thread(target=self._fsync_loop,
+                    args=(stop, fsyncs)),
+                threading.Thread(target=self._read_loop, args=(stop, reads))]
+        for t in threads:
+            t.start()
+        try:
+            start = monotonic()
+            with open(self.bulk_file, 'wb') as f:
+                for _ in range(self.bulk_size // CHUNK_SIZE):
+                    f.write(self.chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            elapsed = monotonic() - start
+        finally:
+            stop.set()
+            for t in threads:
+                t.join()
+        os.remove(self.bulk_file)
+        return Result(name, self.bulk_size / elapsed, fsyncs, reads)
+
+
+def read_current():
+    return {key: _sysctl.read(key) for key in WRITEBACK_KEYS}
+
+def apply_profile(profile):
+    # the keys not in profile are reset, not left from the previous one
+    values = dict(KERNEL_DEFAULTS)
+    values.update(profile)
+    for key, value in values.items():
+        if key in WRITEBACK_KEYS:
+            _sysctl.write(key, value)
+
+def restore(saved):
+    # only one of each pair is set, the other one reads 0
+    for key in WRITEBACK_KEYS:
+        counterpart = COUNTERPARTS.get(key)
+        if counterpart and saved[key] == '0' and saved[counterpart] != '0':
+            continue
+        _sysctl.write(key, saved[key])
+
+def read_profile(path):
+    with open(path) as f:
+        values = parse_conf(f.read())
+    return {k: v for k, v in values.items() if k in WRITEBACK_KEYS}
+
+def _dirty_value(name, value, ram):
+    """Use a ratio if it is precise enough, bytes otherwise."""
+    ratio = round(value * 100 / ram)
+    if ratio >= 1 and abs(ratio * ram / 100 - value) <= value / 4:
+        return {'vm.{}_ratio'.format(name): ratio}
+    return {'vm.{}_bytes'.format(name): value}
+
+def generate_profile(ram, throughput, base=None):
+    """Scale the dirty limits to the RAM and the disk throughput.
+
+    About one second of writes may be dirty before the background
+    writeback starts, and DIRTY_FACTOR times that before writers are
+    throttled.
+    """
+    background = int(min(max(throughput, MIN_BACKGROUND_BYTES),
+        ram * MAX_BACKGROUND_FRACTION))
+    dirty = int(min(background * DIRTY_FACTOR, ram * MAX_DIRTY_FRACTION))
+    profile = {}
+    profile.update(_dirty_value('dirty', dirty, ram))
+    profile.update(_dirty_value('dirty_background', background, ram))
+    for key in ['vm.dirty_expire_centisecs', 'vm.dirty_writeback_centisecs',
+            'vm.vfs_cache_pressure']:
+        if base and key in base:
+            profile[key] = base[key]
+    return profile
+
+def format_profile(profile, ram, result=None):
+    lines = ["# Generated by bench_writeback.py for {} of RAM.".format(
+        format_size(ram))]
+    if result is not None:
+        lines.append("# {}".format(result.describe()))
+    lines += ['{} = {}'.format(k, v) for k, v in profile.items()]
+    return '\n'.join(lines) + '\n'
+
+def merge_profile(path, profile):
+    """Set profile in a sysctl.conf, dropping the other of ratio/bytes."""
+    with open(path) as f:
+        text = f.read()
+    remove = [COUNTERPARTS[k] for k in profile if k in COUNTERPARTS]
+    write_file(path, update_conf(text, profile, remove,
+        comment='writeback settings, see bench_writeback.py'), backup=True)
+
+def _parse_args():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description="")
+    parser.add_argument('dir',
+            help="directory on the filesystem to test")
+    parser.add_argument('-b', '--bulk-size', type=parse_size,
+            help="amount written by the bulk writer, e.g. 4G "
+            "(default: a quarter of the RAM, at most 16G)")
+    parser.add_argument('-p', '--profile', action='append', default=[],
+            help="sysctl file of another candidate profile")
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('-o', '--output',
+            help="write the generated profile to this file, or merge it "
+            "into the file if it exists")
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = _parse_args()
+    if os.geteuid() != 0:
+        sys.exit("The sysctl values can only be changed by root.")
+    ram = total_ram()
+    bulk_size = args.bulk_size or min(ram // 4, 16 * GiB)
+
+    candidates = [('kernel-default', KERNEL_DEFAULTS)]
+    if os.path.exists(SYSCTL_CONF_FILE):
+        candidates.append(('current', read_profile(SYSCTL_CONF_FILE)))
+    for path in args.profile:
+        candidates.append((os.path.basename(path), read_profile(path)))
+
+    workload = Workload(args.dir, bulk_size, seed=args.seed)
+    saved = read_current()
+    results = []
+    try:
+        workload.prepare()
+        for name, profile in candidates:
+            print("Running profile {}...".format(name))
+            apply_profile(profile)
+            result = workload.run(name)
+            print("\t{}".format(result.describe()))
+            results.append((result, profile))
+
+        best = max(r.throughput for r, _ in results)
+        generated = generate_profile(ram, best, dict(candidates).get('current'))
+        print("Running the generated profile...")
+        apply_profile(generated)
+        result = workload.run('generated')
+        print("\t{}".format(result.describe()))
+        results.append((result, generated))
+    finally:
+        restore(saved)
+        workload.cleanup()
+
+    print("Results, by fsync p99:")
+    for r, _ in sorted(results, key=lambda x: percentile(x[0].fsyncs, 0.99)):
+        print("\t{}: {}".format(r.name, r.describe()))
+
+    content = format_profile(generated, ram, result)
+    if args.output is None:
+        print(content, end='')
+    elif os.path.exists(args.output):
+        merge_profile(args.output, generated)
+        print("{} updated.".format(args.output))
+    else:
+        write_file(args.output, content)
+        print("{} written.".format(args.output))
+
+
+if __name__ == '__main__':
+    main()
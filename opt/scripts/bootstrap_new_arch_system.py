@@ -31,6 +31,12 @@ After running this script, there are some steps remaining:
     copy .mozilla, .config/chromium folders
     install non-official packages
 
+All the questions (host name, admin user, passwords) are asked at the
+start, then the steps run unattended, independent ones concurrently.
+
+If a step fails, fix the problem and re-run with --resume, the finished
+steps are recorded in STATE_FILE and will be skipped.
+
 """
 import sys
 import os
@@ -39,28 +45,73 @@ from subprocess import Popen, PIPE
 import pwd
 import grp
 import shutil
+import getpass
 from io import StringIO
+from functools import partial
 
 from _utils import *
+from _git import GIT_CACHE_DIR, checkout_cmds, clone_cmds, run_parallel
+from _pacman import read_package_list, plan_install, install_batches
+from _steps import Step, StepState, add_step_args, select_steps, run_steps
 
 
 PACKAGES_LIST_FILE = '/etc/installed_packages'
 DEFAULT_ADMIN_USER = 'statistician'
 ADMIN_SYSTEM_GROUPS = ['wheel', 'raise_nofile_limit']
 
+HOME_CONFIG_REPO = 'git@github.com:kawing-chiu/arch-config-home.git'
+DOTVIM_REPO = 'git@github.com:kawing-chiu/dotvim.git'
+EXC_REPO = 'git@github.com:kawing-chiu/exc.git'
+USER_REPOS = [HOME_CONFIG_REPO, DOTVIM_REPO, EXC_REPO]
+
+# written by prepare_arch_chroot.py when the packages of PACKAGES_LIST_FILE
+# are in the (bind-mounted) package cache, with the sync dbs they came from
+PREFETCH_MARKER = '/var/lib/bootstrap_new_arch_system/prefetched'
+# records the finished steps, for --resume
+STATE_FILE = '/var/lib/bootstrap_new_arch_system/state.json'
+# output of the commands, and their timeline in the Chrome trace format
+LOG_FILE = '/var/log/bootstrap_new_arch_system/commands.log'
+TRACE_FILE = '/var/log/bootstrap_new_arch_system/trace.json'
+# globals set by some steps and needed by later ones
+SAVED_VARS = ['ADMIN_USER_NAME']
+
 
 def install_packages():
     print("Installing packages...")
     run(['pacman-key', '--init'])
     run(['pacman-key', '--populate', 'archlinux'])
-    with open(PACKAGES_LIST_FILE, 'rb') as f:
-        packages = f.read()
-    p = Popen(['pacman', '-Syu', '--needed', '-'], stdin=PIPE)
-    p.communicate(input=packages)
-
-def set_host_name():
+    if os.path.exists(PREFETCH_MARKER):
+        # the sync dbs match the cache, refreshing them would mean
+        # downloading newer packages
+        print("\tusing the packages prefetched by prepare_arch_chroot.py")
+        run(['pacman', '-Su', '--noconfirm'])
+    else:
+        run(['pacman', '-Syu', '--noconfirm'])
+
+    plan = plan_install(read_package_list(PACKAGES_LIST_FILE))
+    plan.print_summary()
+    failed = install_batches(plan.batches)
+    if failed:
+        print("\tWARNING: failed to install: {}".format(' '.join(failed)))
+    # later runs refresh the dbs again
+    if os.path.exists(PREFETCH_MARKER):
+        os.remove(PREFETCH_MARKER)
+
+def ask_password(user):
+    while True:
+        password = getpass.getpass("Password for {}: ".format(user))
+        if password and password == getpass.getpass("Retype password: "):
+            return password
+        print("Passwords do not match or are empty, try again.")
+
+def set_password(user, password):
+    run(['chpasswd'], input='{}:{}\n'.format(user, password))
+
+def ask_host_name():
+    return input("Input hostname: ")
+
+def set_host_name(host_name):
     print("Setting hostname...")
-    host_name = input("Input hostname: ")
     with open('/etc/hostname', 'w') as f:
         print(host_name, file=f)
 
@@ -117,9 +168,12 @@ def unbound_setup():
 #    with open('/etc/goagent', 'w') as f:
 #        f.write(config_template)
 
-def change_root_password():
+def ask_root_password():
+    return ask_password('root')
+
+def change_root_password(password):
     print("Setting root password...")
-    run(['passwd'])
+    set_password('root', password)
 
 def add_special_groups():
     print("Adding special groups...")
@@ -130,16 +184,19 @@ def add_special_groups():
             print("\tadding group {}".format(group))
             run(['groupadd', '--system', group])
 
-def create_admin_user():
-    print("Creating admin user...")
-
+def ask_admin_user():
     # TODO: add full support for installing system for user other than myself
     user = input("Input the user name of the admin user(empty for default): ")
     user = user.strip()
     if not user:
         user = DEFAULT_ADMIN_USER
+    # needed by the later steps, even if this one is done on --resume
     global ADMIN_USER_NAME
     ADMIN_USER_NAME = user
+    return ask_password(user)
+
+def create_admin_user(password):
+    print("Creating admin user...")
 
     run(['useradd', '-m', '-U', '-s', '/bin/bash',
         ADMIN_USER_NAME])
@@ -148,7 +205,7 @@ def create_admin_user():
         run(['gpasswd', '-a', ADMIN_USER_NAME, group])
 
     print("Setting password for {}...".format(ADMIN_USER_NAME))
-    run(['passwd', ADMIN_USER_NAME])
+    set_password(ADMIN_USER_NAME, password)
 
 def copy_ssh_keys():
     user_name = ADMIN_USER_NAME
@@ -164,33 +221,37 @@ def copy_ssh_keys():
         shutil.copy(src, dest)
         shutil.chown(dest, uid, gid)
 
-def get_user_config():
+def confirm_user_config():
+    input("The user configs will be loaded from github, "
+            "press any key to continue...")
+
+def get_user_config(_confirmed):
     print("Loading user configs from github...")
 
     copy_ssh_keys()
 
-    input("Press any key to continue...")
-
-    run_as_user(ADMIN_USER_NAME, ['git', 'init'])
-    run_as_user(ADMIN_USER_NAME, ['git', 'remote', 'add', 'origin',
-        'git@github.com:kawing-chiu/arch-config-home.git'])
-    run_as_user(ADMIN_USER_NAME, ['git', 'fetch'])
-    run_as_user(ADMIN_USER_NAME, ['git', 'checkout',
-        '-t', '-f', 'origin/master'])
+    # the git cache is bind mounted by prepare_arch_chroot.py, if it
+    # exists the objects are taken from it
+    if os.path.isdir(GIT_CACHE_DIR):
+        print("\tusing git cache in {}".format(GIT_CACHE_DIR))
+    run_parallel([
+        (checkout_cmds(HOME_CONFIG_REPO), None),
+        (clone_cmds(DOTVIM_REPO, '.vim', recursive=True), None),
+        (clone_cmds(EXC_REPO, 'exercises'), None),
+    ], partial(run_as_user, ADMIN_USER_NAME))
 
-    run_as_user(ADMIN_USER_NAME, ['git', 'clone', '--recursive',
-        'git@github.com:kawing-chiu/dotvim.git', '.vim'])
+def ask_samba_password():
+    return ask_password('{} (samba)'.format(ADMIN_USER_NAME))
 
-    run_as_user(ADMIN_USER_NAME, ['git', 'clone',
-        'git@github.com:kawing-chiu/exc.git', 'exercises'])
-
-def config_samba():
+def config_samba(password):
     print("Configuring samba...")
-    run(['smbpasswd', '-a', ADMIN_USER_NAME])
+    # -s reads the password twice from stdin
+    run(['smbpasswd', '-s', '-a', ADMIN_USER_NAME],
+            input='{0}\n{0}\n'.format(password))
     qemu_share_dir = 'qemu_share'
-    call_f_as_user(ADMIN_USER_NAME, os.makedirs,
-            args=(qemu_share_dir,),
-            kwargs={'exist_ok': True})
+    # a new process, not the user worker: forking it from a step's
+    # thread could deadlock on a lock held by another thread
+    run_as_user(ADMIN_USER_NAME, ['mkdir', '-p', qemu_share_dir])
 
 def create_efi_mount_point():
     efi_dir = '/boot/efi'
@@ -204,26 +265,69 @@ def note():
     print("Also check /etc/fstab to confirm everything is ok, i.e. "
             "whether the swap file entry is added.")
 
-def main():
-    install_packages()
-    set_host_name()
-    set_time_zone()
-    set_local_time()
-    gen_locales()
-    make_initramfs()
-
-    unbound_setup()
-
+# the steps changing installed files, users or groups wait for pacman,
+# whose install scripts also change them
+STEPS = [
+    Step(install_packages, inputs=[PACKAGES_LIST_FILE]),
+    Step(set_host_name, outputs=['/etc/hostname'], prompt=ask_host_name),
+    # links to tzdata, and runs hwclock from util-linux
+    Step(set_time_zone, outputs=['/etc/localtime'],
+        deps=['install_packages']),
+    # hwclock --localtime reads the zone from /etc/localtime
+    Step(set_local_time, outputs=['/etc/adjtime'],
+        deps=['install_packages', 'set_time_zone']),
+    Step(gen_locales, inputs=['/etc/locale.gen'],
+        outputs=['/usr/lib/locale/locale-archive'],
+        deps=['install_packages']),
+    Step(make_initramfs,
+        inputs=['/etc/mkinitcpio.conf', '/etc/mkinitcpio.d/linux.preset',
+            '/boot/vmlinuz-linux'],
+        outputs=['/boot/initramfs-linux.img'],
+        deps=['install_packages']),
+    Step(unbound_setup, outputs=['/etc/unbound/unbound_server.key',
+        '/etc/unbound/unbound_control.key'],
+        deps=['install_packages']),
     # not needed anymore
-    #goagent_setup()
+    #Step(goagent_setup),
+    Step(change_root_password, deps=['install_packages'],
+        prompt=ask_root_password),
+    # the shadow tools fail rather than wait when another one holds the
+    # lock of /etc/passwd, so the steps changing users run one by one
+    Step(add_special_groups,
+        deps=['install_packages', 'change_root_password']),
+    Step(create_admin_user, deps=['add_special_groups'],
+        prompt=ask_admin_user),
+    Step(get_user_config, deps=['create_admin_user'],
+        prompt=confirm_user_config),
+    Step(config_samba, deps=['install_packages', 'create_admin_user'],
+        prompt=ask_samba_password),
+    Step(create_efi_mount_point),
+]
+
+def _parse_args():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description="")
+    add_step_args(parser, STEPS)
+    args = parser.parse_args()
+    return args
 
-    change_root_password()
-    add_special_groups()
-    create_admin_user()
-    get_user_config()
-    config_samba()
-
-    create_efi_mount_point()
+def main():
+    args = _parse_args()
+
+    state = StepState(STATE_FILE)
+    globals().update(state.vars)
+
+    def save_vars(step):
+        for name in SAVED_VARS:
+            if name in globals():
+                state.vars[name] = globals()[name]
+
+    TIMELINE.set_log(LOG_FILE)
+    try:
+        run_steps(select_steps(STEPS, args), state, resume=args.resume,
+                on_done=save_vars, max_workers=args.jobs)
+    finally:
+        TIMELINE.report(TRACE_FILE)
     note()
 
     print("Done.")
@@ -6,32 +6,94 @@ package list:
 
     cat /etc/installed_packages | pacman -S --needed -
 
+The local pacman db is read directly, an index of it is kept in INDEX_FILE
+so that repeated runs (e.g. from a pacman hook) only parse what changed.
 """
-import subprocess
+
+from _pacman import (LocalDB, REASON_EXPLICIT, dependency_graph, closure,
+        minimize_roots, expand_groups, sync_groups)
+from _utils import write_file
 
 OUT_PKG_FILE = '/etc/installed_packages'
+INDEX_FILE = '/var/cache/gen_installed_packages/index.json'
+
+
+def _read_list(path):
+    try:
+        with open(path) as f:
+            return [line.strip() for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+def _write_list(path, pkgs):
+    write_file(path, ''.join(pkg + '\n' for pkg in pkgs))
+
+def print_diff(path, old, new):
+    old, new = set(old), set(new)
+    if old == new:
+        return
+    print("{}:".format(path))
+    for pkg in sorted(new - old):
+        print("\t+ {}".format(pkg))
+    for pkg in sorted(old - new):
+        print("\t- {}".format(pkg))
 
+def minimize(pkgs, roots):
+    """Return the smallest list of roots with the same closure."""
+    print("Minimizing package list...")
+    graph = dependency_graph(pkgs)
+    groups = sync_groups()
+    new_roots, pulled_in_by = minimize_roots(roots, graph, groups)
+
+    # verify
+    old_closure = closure(roots, graph)
+    new_closure = closure(expand_groups(new_roots, groups), graph)
+    print("\t{} explicit packages -> {} roots".format(
+        len(roots), len(new_roots)))
+    for name in sorted(pulled_in_by):
+        print("\t{} (pulled in by {})".format(name, pulled_in_by[name]))
+    if old_closure == new_closure:
+        print("\tverified: same closure of {} packages".format(
+            len(old_closure)))
+    else:
+        print("\tWARNING: closure differs, missing: {}, extra: {}".format(
+            ' '.join(sorted(old_closure - new_closure)) or '-',
+            ' '.join(sorted(new_closure - old_closure)) or '-'))
+        return roots
+    return new_roots
 
 def main():
     args = _parse_args()
-    with open(OUT_PKG_FILE, 'w') as f:
-        p = subprocess.Popen(['pacman', '-Qqen'], stdout=f)
-        p.wait()
+    pkgs = LocalDB(index_file=INDEX_FILE).packages()
+
+    # same as `pacman -Qqen` and `pacman -Qqm`
+    explicit = sorted(p.name for p in pkgs.values()
+            if p.reason == REASON_EXPLICIT and p.repo is not None)
+    if args.minimize:
+        explicit = minimize(pkgs, explicit)
+    lists = {OUT_PKG_FILE: explicit}
     if args.local:
-        with open(OUT_PKG_FILE + '_local', 'w') as f:
-            p = subprocess.Popen(['pacman', '-Qqm'], stdout=f)
-            p.wait()
+        lists[OUT_PKG_FILE + '_local'] = sorted(p.name for p in pkgs.values()
+                if p.repo is None)
+
+    for path, new in lists.items():
+        if args.diff:
+            print_diff(path, _read_list(path), new)
+        _write_list(path, new)
 
 def _parse_args():
     from argparse import ArgumentParser
     parser = ArgumentParser(description="")
     parser.add_argument('-l', '--local', action='store_true',
             help="also update non-official packages list")
+    parser.add_argument('-d', '--diff', action='store_true',
+            help="show the changes from the previous lists")
+    parser.add_argument('-m', '--minimize', action='store_true',
+            help="leave out the packages that are dependencies of other "
+            "listed packages, and use groups where possible")
     args = parser.parse_args()
     return args
 
 
 if __name__ == '__main__':
     main()
-
-
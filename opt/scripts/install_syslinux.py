@@ -10,6 +10,7 @@ import shutil
 import re
 
 from _utils import *
+from _copy import file_hash
 
 # TODO: clean up the code, it's too ugly
 
@@ -54,13 +55,35 @@ def copy_syslinux_bios_files(target_path):
         if file_.endswith('.c32'):
             shutil.copy(os.path.join(syslinux_files_dir, file_), target_path)
 
+def _same_content(src, dest):
+    if not os.path.exists(dest):
+        return False
+    if os.path.getsize(src) != os.path.getsize(dest):
+        return False
+    return file_hash(src) == file_hash(dest)
+
 def copy_arch_boot_files(target_path):
+    """Copy the kernel and initramfs, skipping the ones not changed.
+
+    Returns the number of files written.
+    """
     if not os.path.exists(target_path):
         os.makedirs(target_path)
 
     print("Copying arch boot files to {}...".format(target_path))
-    for file_ in ['initramfs-linux.img', 'vmlinuz-linux']:
-        shutil.copy(os.path.join('/boot/', file_), target_path)
+    written = 0
+    # kernel and initramfs are replaced together, and durably
+    with AtomicWrites() as files:
+        for file_ in ['initramfs-linux.img', 'vmlinuz-linux']:
+            src = os.path.join('/boot/', file_)
+            dest = os.path.join(target_path, file_)
+            if _same_content(src, dest):
+                print("\t{} unchanged".format(file_))
+                continue
+            print("\tupdating {}".format(file_))
+            files.copy(src, dest)
+            written += 1
+    return written
 
 #def set_efi_boot_entry(path):
 #    print("Creating EFI boot entry...")
@@ -107,9 +130,8 @@ def create_syslinux_cfg(syslinux_path, arch_path, crypt_path, crypt_name, type_)
     config = '\n'.join(lines)
 
     cfg_file = os.path.join(syslinux_path, 'syslinux.cfg')
-    with open(cfg_file, 'w') as f:
-        print("\tcreate syslinux UEFI config file {}".format(cfg_file))
-        f.write(config)
+    print("\tcreate syslinux UEFI config file {}".format(cfg_file))
+    write_file(cfg_file, config)
 
 def install_syslinux_uefi(arch_path, syslinux_uefi_path, crypt_path, crypt_name):
     copy_syslinux_uefi_files(syslinux_uefi_path)
@@ -129,7 +151,7 @@ def install_syslinux_bios(arch_path, syslinux_bios_path, device, part_num, crypt
 
     print("Writing MBR...")
     mbr_bin_file = '/usr/lib/syslinux/bios/gptmbr_c.bin'
-    run(['dd', 'bs=440', 'count=1', 'conv=notrunc',
+    run(['dd', 'bs=440', 'count=1', 'conv=notrunc,fsync',
         'if=' + mbr_bin_file, 'of=' + device])
 
     print("Setting bootflag...")
@@ -154,9 +176,15 @@ def _parse_args():
             help="mount point of EFI partition, e.g. /boot/efi")
     parser.add_argument('-u', '--update', action='store_true',
             help="update kernel only")
+    parser.add_argument('-y', '--yes', action='store_true',
+            help="do not ask for confirmation, e.g. in a pacman hook")
     args = parser.parse_args()
 
     if not os.path.ismount(args.mount_point):
+        if args.update:
+            # e.g. from the pacman hook while bootstrapping a chroot, there
+            # is nothing to update yet
+            sys.exit(0)
         sys.exit("Error: '{}' is not a mount point".format(args.mount_point))
 
     return args
@@ -182,22 +210,27 @@ def main():
     arch_path = os.path.join(mount_point, ARCH_PATH)
     print("\tarch_path: {}".format(arch_path))
 
-    confirm = input("Check the above information and confirm (type uppercase yes): ")
-    if confirm != 'YES':
-        sys.exit()
+    if not args.yes:
+        confirm = input("Check the above information and confirm (type uppercase yes): ")
+        if confirm != 'YES':
+            sys.exit()
 
     #_test_paths([syslinux_uefi_path, syslinux_bios_path])
     if args.update:
+        # synced by copy_arch_boot_files
         copy_arch_boot_files(arch_path)
-    else:
-        crypt_path = input("Input the path of the encrypted partition, "
-                "i.e. /dev/sda3: ").strip()
-        crypt_name = input("The name of the crypt device, i.e. luks_on_sdxc: ")
+        print("Done.")
+        return
+
+    crypt_path = input("Input the path of the encrypted partition, "
+            "i.e. /dev/sda3: ").strip()
+    crypt_name = input("The name of the crypt device, i.e. luks_on_sdxc: ")
 
-        install_syslinux_uefi(arch_path, syslinux_uefi_path, crypt_path, crypt_name)
-        install_syslinux_bios(arch_path, syslinux_bios_path, device, part_num, crypt_path, crypt_name)
+    install_syslinux_uefi(arch_path, syslinux_uefi_path, crypt_path, crypt_name)
+    install_syslinux_bios(arch_path, syslinux_bios_path, device, part_num, crypt_path, crypt_name)
 
-    run(['sync'])
+    # only the EFI partition, not every disk
+    syncfs(mount_point)
 
     print("Done.")
 
@@ -1,10 +1,19 @@
 #!/usr/bin/env python3
 """Load encrypted external hard drives.
+
+With --all, the drives present (found by UUID in /dev/disk/by-uuid) are
+loaded, or the loaded ones unloaded, concurrently. The mapper device of a
+drive is waited for with inotify before its volume group is activated.
+Errors are reported per drive.
 """
 import sys
 import os
+import select
+import ctypes
 import subprocess
-from time import sleep
+from subprocess import PIPE, STDOUT
+from time import sleep, monotonic
+from concurrent.futures import ThreadPoolExecutor
 
 
 KNOWN_DRIVES = {
@@ -20,51 +29,168 @@ KNOWN_DRIVES = {
     }
 }
 
+UUID_DIR = '/dev/disk/by-uuid/'
+MAPPER_DIR = '/dev/mapper/'
+KEY_FILE = '/root/.mykeyfile'
+# how long to wait for the mapper device after luksOpen
+MAPPER_TIMEOUT = 10
+
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_CLOEXEC = 0o2000000
+
+
+class DriveError(Exception):
+    pass
+
+
+def _inotify_watch(dir_):
+    """Returns an inotify fd watching dir_ for new entries, or None."""
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, dir_.encode(), IN_CREATE | IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+def wait_for_path(path, timeout):
+    """Wait for path to appear, returns False on timeout.
+
+    Falls back to polling when inotify cannot be used.
+    """
+    if os.path.exists(path):
+        return True
+    fd = _inotify_watch(os.path.dirname(path))
+    deadline = monotonic() + timeout
+    try:
+        # checked again after the watch is set up, not to miss the event
+        while not os.path.exists(path):
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return False
+            if fd is None:
+                sleep(min(0.05, remaining))
+            elif select.select([fd], [], [], remaining)[0]:
+                os.read(fd, 4096)
+        return True
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+def _run(cmd):
+    """Run cmd, returns its output or raises DriveError."""
+    p = subprocess.run(cmd, stdout=PIPE, stderr=STDOUT,
+            universal_newlines=True)
+    if p.returncode != 0:
+        raise DriveError("'{}' failed with code {}: {}".format(
+            ' '.join(cmd), p.returncode, p.stdout.strip()))
+    return p.stdout
+
+def map_path(drive):
+    return os.path.join(MAPPER_DIR, drive['LUKS_NAME'])
+
+def present_drives():
+    """Returns the names of the known drives plugged in."""
+    try:
+        uuids = set(os.listdir(UUID_DIR))
+    except FileNotFoundError:
+        return []
+    return [name for name, drive in KNOWN_DRIVES.items()
+            if drive['UUID'] in uuids]
+
+def loaded_drives():
+    return [name for name, drive in KNOWN_DRIVES.items()
+            if os.path.exists(map_path(drive))]
 
 def load_drive(drive):
-    print("Unlocking encrypted device...")
-    cmdline = ['cryptsetup', '-v', '-d', '/root/.mykeyfile','luksOpen',
-            'UUID=' + drive['UUID'], drive['LUKS_NAME']]
-    subprocess.call(cmdline)
-    sleep(0.3)
-    print("Activating lvm volume group...")
-    subprocess.call(['vgchange', '-a', 'y', drive['LVM_NAME']])
+    print("Unlocking encrypted device {}...".format(drive['LUKS_NAME']))
+    _run(['cryptsetup', '-v', '-d', KEY_FILE, 'luksOpen',
+        'UUID=' + drive['UUID'], drive['LUKS_NAME']])
+    if not wait_for_path(map_path(drive), MAPPER_TIMEOUT):
+        raise DriveError("{} did not appear in {} s".format(
+            map_path(drive), MAPPER_TIMEOUT))
+    print("Activating lvm volume group {}...".format(drive['LVM_NAME']))
+    _run(['vgchange', '-a', 'y', drive['LVM_NAME']])
 
 def unload_drive(drive):
-    print("Deactivating lvm volume group...")
-    subprocess.call(['vgchange', '-a', 'n', drive['LVM_NAME']])
-    print("Closing encrypted device...")
-    subprocess.call(['cryptsetup', '-v', 'luksClose', drive['LUKS_NAME']])
+    print("Deactivating lvm volume group {}...".format(drive['LVM_NAME']))
+    _run(['vgchange', '-a', 'n', drive['LVM_NAME']])
+    print("Closing encrypted device {}...".format(drive['LUKS_NAME']))
+    _run(['cryptsetup', '-v', 'luksClose', drive['LUKS_NAME']])
+
+def apply_all(f, names):
+    """Call f on the drives concurrently, returns {name: error or None}."""
+    def _one(name):
+        try:
+            f(KNOWN_DRIVES[name])
+        except (DriveError, OSError) as e:
+            return e
+        return None
+
+    if not names:
+        return {}
+    with ThreadPoolExecutor(max_workers=len(names)) as executor:
+        return dict(zip(names, executor.map(_one, names)))
 
 def _parse_args():
     from argparse import ArgumentParser
     parser = ArgumentParser(description="")
     parser.add_argument('action', choices=['load', 'unload'])
-    parser.add_argument('drive')
+    parser.add_argument('drive', nargs='?')
+    parser.add_argument('-a', '--all', action='store_true',
+            help="all the drives present (load) or loaded (unload)")
     args = parser.parse_args()
+    if (args.drive is None) == (not args.all):
+        parser.error("give either a drive or --all")
     return args
 
 def run():
     args = _parse_args()
+    action = args.action
+
+    if args.all:
+        if action == 'load':
+            names = [n for n in present_drives() if n not in loaded_drives()]
+            f = load_drive
+        else:
+            names = loaded_drives()
+            f = unload_drive
+        if not names:
+            print("No drive to {}.".format(action))
+            return
+        print("Drives to {}: {}".format(action, ', '.join(names)))
+        errors = apply_all(f, names)
+        for name, error in errors.items():
+            print("\t{}: {}".format(name, 'ok' if error is None
+                else 'failed, {}'.format(error)))
+        if any(errors.values()):
+            sys.exit(1)
+        return
+
     if args.drive not in KNOWN_DRIVES:
         sys.exit("Unknown drive {}.".format(args.drive))
     drive = KNOWN_DRIVES[args.drive]
-    action = args.action
 
-    map_path = os.path.join('/dev/mapper/', drive['LUKS_NAME'])
-    if action == 'load':
-        if os.path.exists(map_path):
-            print("Drive '{}' already loaded.".format(args.drive))
-            return
-        load_drive(drive)
+    try:
+        if action == 'load':
+            if os.path.exists(map_path(drive)):
+                print("Drive '{}' already loaded.".format(args.drive))
+                return
+            load_drive(drive)
 
-    elif action == 'unload':
-        if not os.path.exists(map_path):
-            print("Drive '{}' not loaded.".format(args.drive))
-            return
-        unload_drive(drive)
+        elif action == 'unload':
+            if not os.path.exists(map_path(drive)):
+                print("Drive '{}' not loaded.".format(args.drive))
+                return
+            unload_drive(drive)
+    except DriveError as e:
+        sys.exit("Drive '{}': {}".format(args.drive, e))
 
 
 if __name__ == "__main__":
     run()
-
@@ -11,22 +11,38 @@ using cryptsetup and lvm. Some commands for reference:
     lvcreate -v -n <lv_name> -L/-l <size> <vg_name>
     mkfs.ext4 -v /dev/<vg_name>/<lv_name>
 
+The questions are asked at the start, then the steps run unattended
+until the chroot shell, independent ones concurrently.
+
+The packages of pacstrap are downloaded to the host's package cache from
+the start, while the questions are asked, and pacstrap installs from that
+cache. Then the ones of the package list in the system configs are
+downloaded with the sync dbs of the target, and the cache is
+bind-mounted into the chroot, so that bootstrap_new_arch_system.py
+installs them without downloading anything.
 """
 import sys
 import os
 import subprocess
-from subprocess import Popen
 import shutil
+from functools import partial
 
 from _utils import *
-from bootstrap_new_arch_system import DEFAULT_ADMIN_USER
+from _copy import Copier
+from _git import (GIT, GIT_CACHE_DIR, checkout_cmds, mirror_path,
+        run_parallel, update_mirrors)
+from _pacman import (PACKAGE_CACHE_DIR, PREFETCH_DB_DIR, PACMAN_DB_DIR,
+        parse_package_list, prefetch)
+from _steps import Step, StepState, run_steps
+from _swap import (MODES, PROFILES, plan_swap, format_size, parse_size,
+        write_config)
+from bootstrap_new_arch_system import (DEFAULT_ADMIN_USER, USER_REPOS,
+        PACKAGES_LIST_FILE, PREFETCH_MARKER)
 
 # TODO:
 # 1. 将所有script整理成一个package(如何调用比较方便？)
 # 2. 安装可以分开三个stage: stage1, stage2(in chroot), stage3
-# 3. 输出所有执行的命令
-# 4. 在各个步骤之前提示确认
-# 5. log到文件(包括subprocess的输出)
+# 3. 在各个步骤之前提示确认
 
 
 ROOT_FILE_LIST = [
@@ -49,22 +65,68 @@ USER_FILE_LIST = [
     '~/.config/chromium',
 ]
 
+# manifest of copied files for --sync, relative to the target dir
+COPY_MANIFEST = '~/.cache/prepare_arch_chroot/copy_manifest.json'
+
+# output of the commands, and their timeline in the Chrome trace format
+LOG_FILE = '/var/log/prepare_arch_chroot/commands.log'
+TRACE_FILE = '/var/log/prepare_arch_chroot/trace.json'
+
 # a relative path should be used
 SWAP_FILE = 'swapfile'
 
+ROOT_CONFIG_REPO = 'git@github.com:kawing-chiu/arch-config-root.git'
+
+PACSTRAP_PACKAGES = ['base', 'base-devel', 'vim', 'git', 'openssh', 'python',
+        'bash-completion', 'xorg', 'clang', 'vlc', 'firefox', 'chromium',
+        'archlinux-keyring']
+
+# shared with the chroot, so that nothing is downloaded twice
+BIND_DIRS = [GIT_CACHE_DIR, PACKAGE_CACHE_DIR]
+
+
+def _prefetch(pkgs, refresh):
+    # the output would be mixed with the questions, it is in the log
+    unknown = prefetch(pkgs, refresh=refresh, run_f=partial(run, quiet=True))
+    if unknown:
+        TIMELINE.write_log("WARNING: not prefetching unknown packages: "
+                "{}\n".format(' '.join(unknown)))
+
+def prefetch_base():
+    # an early step, silent
+    _prefetch(PACSTRAP_PACKAGES, refresh=True)
+
+def _copy_sync_dbs(src_dir, dst_dir):
+    os.makedirs(dst_dir, exist_ok=True)
+    for file_ in os.listdir(src_dir):
+        # with the mtime, which pacman -Sy compares with the mirror's
+        shutil.copy2(os.path.join(src_dir, file_), dst_dir)
 
 def pacstrap(target_dir):
     print("Running pacstrap...")
-    # TODO: consider installing more packages here so that we can save the time
-    # downloading the packages inside the chroot
-    pkgs = ['base', 'base-devel', 'vim', 'git', 'openssh', 'python',
-            'bash-completion', 'xorg', 'clang', 'vlc', 'firefox', 'chromium',
-            'archlinux-keyring']
+    # pacstrap always refreshes the dbs, with the ones prefetch_base
+    # used it finds them up to date, unless a mirror changed since
+    _copy_sync_dbs(os.path.join(PREFETCH_DB_DIR, 'sync'),
+            target_dir + os.path.join(PACMAN_DB_DIR, 'sync'))
     # '-c' means to use the package cache on the host
-    #run(['pacstrap', '-c', target_dir, *pkgs])
-    run(['pacstrap', '-G', target_dir, *pkgs])
+    run(['pacstrap', '-c', '-G', target_dir, *PACSTRAP_PACKAGES])
 
-def _copy_to_dir(target_dir, file_):
+def prefetch_all(target_dir):
+    print("Downloading the packages of the system configs...")
+    # the dbs pacstrap ended up with, so that the rest of the packages
+    # match the installed ones and the dbs of the target
+    _copy_sync_dbs(target_dir + os.path.join(PACMAN_DB_DIR, 'sync'),
+            os.path.join(PREFETCH_DB_DIR, 'sync'))
+    # the list in the mirror fetched by fetch_config, not checked out yet
+    text = subprocess.check_output(GIT + ['-C', mirror_path(ROOT_CONFIG_REPO),
+        'show', 'master:' + PACKAGES_LIST_FILE.lstrip('/')],
+        universal_newlines=True)
+    _prefetch(parse_package_list(text), refresh=False)
+    marker = target_dir + PREFETCH_MARKER
+    os.makedirs(os.path.dirname(marker), exist_ok=True)
+    write_file(marker, '')
+
+def _copy_to_dir(copier, target_dir, file_):
     file_ = os.path.abspath(os.path.expanduser(file_))
     print("\tcopying {}".format(file_))
     if not os.path.exists(file_):
@@ -75,77 +137,156 @@ def _copy_to_dir(target_dir, file_):
         new_dir = target_dir + dir_
         print("\tto: {}".format(new_dir))
         os.makedirs(new_dir, exist_ok=True)
-        return shutil.copy(file_, new_dir)
+        copier.copy(file_, os.path.join(new_dir, base))
     else:
         dir_ = file_
         new_dir = target_dir + dir_
         print("\tto: {}".format(new_dir))
-        return shutil.copytree(file_, new_dir, symlinks=True)
+        copier.copytree(file_, new_dir)
+
+def _copy_files(target_dir, file_list, sync=False, checksum=False):
+    manifest = None
+    if sync:
+        manifest = target_dir + os.path.expanduser(COPY_MANIFEST)
+    with Copier(manifest=manifest, checksum=checksum) as copier:
+        for file_ in file_list:
+            _copy_to_dir(copier, target_dir, file_)
+    print("\tcopied {}".format(copier.stats.summary()))
 
-def copy_root_files(target_dir, file_list):
+def copy_root_files(target_dir, file_list, **kwargs):
     print("Copying files...")
-    for file_ in file_list:
-        _copy_to_dir(target_dir, file_)
+    _copy_files(target_dir, file_list, **kwargs)
 
-def copy_user_files(target_dir, file_list):
+def copy_user_files(target_dir, file_list, **kwargs):
     print("Copying user files...")
-    for file_ in file_list:
-        call_f_as_user(DEFAULT_ADMIN_USER, _copy_to_dir, (target_dir, file_))
+    call_f_as_user(DEFAULT_ADMIN_USER, _copy_files, (target_dir, file_list),
+            kwargs)
 
 def gen_fstab(target_dir):
     print("Generating fstab...")
     out_fstab = target_dir + '/etc/fstab'
-    with open(out_fstab, 'ab') as f:
-        p = Popen(['genfstab', '-p', target_dir], stdout=f)
-        p.communicate()
+    with open(out_fstab, 'rb') as f:
+        old = f.read()
+    new = subprocess.check_output(['genfstab', '-p', target_dir])
+    write_file(out_fstab, old + new)
 
 def chroot(target_dir):
     print("Chrooting...")
-    #os.execvp('arch-chroot', ['arch-chroot', target_dir, '/bin/bash'])
-    run(['arch-chroot', target_dir, '/bin/bash'])
-
-def get_config(target_dir):
-    print("Loading system configs from github...")
-
-    input("Press any key to continue...")
+    # share the caches with bootstrap_new_arch_system.py
+    mounted = []
+    try:
+        for dir_ in BIND_DIRS:
+            os.makedirs(dir_, exist_ok=True)
+            cache_dir = target_dir + dir_
+            os.makedirs(cache_dir, exist_ok=True)
+            run(['mount', '--bind', dir_, cache_dir])
+            mounted.append(cache_dir)
+        #os.execvp('arch-chroot', ['arch-chroot', target_dir, '/bin/bash'])
+        # an interactive shell, its output cannot be captured
+        run(['arch-chroot', target_dir, '/bin/bash'], capture=False)
+    finally:
+        for cache_dir in reversed(mounted):
+            run(['umount', cache_dir])
 
-    old_cwd = os.getcwd()
-    os.chdir(target_dir)
+def confirm_config():
+    input("The system configs will be loaded from github, "
+            "press any key to continue...")
 
-    run(['git', 'init'])
-    run(['git', 'remote', 'add', 'origin',
-        'git@github.com:kawing-chiu/arch-config-root.git'])
-    run(['git', 'fetch'])
-    run(['git', 'checkout', '-t', '-f', 'origin/master'])
+def fetch_config(_confirmed):
+    print("Fetching system configs from github...")
+    # also fetch the repos needed later inside the chroot, all at once
+    update_mirrors([ROOT_CONFIG_REPO, *USER_REPOS], run)
 
-    os.chdir(old_cwd)
+def checkout_config(target_dir):
+    print("Checking out system configs...")
+    run_parallel([(checkout_cmds(ROOT_CONFIG_REPO), target_dir)], run)
 
-def create_swap_file(target_dir):
+def create_swap_file(target_dir, size):
     print("Creating swap file...")
-    size = input("The size of the swap file: ")
     swap_file = os.path.join(target_dir, SWAP_FILE)
     run(['fallocate', '-l', size, swap_file])
     run(['chmod', '600', swap_file])
     run(['mkswap', swap_file])
 
+def ask_swap_plan(mode, profile):
+    plan = plan_swap(mode, profile)
+    if plan.disk_size:
+        size = input("The size of the swap file [{}]: ".format(
+            format_size(plan.disk_size))).strip()
+        if size:
+            plan.disk_size = parse_size(size)
+    return plan
+
+def setup_swap(target_dir, plan):
+    print("Setting up swap...")
+    for line in plan.describe():
+        print("\t{}".format(line))
+    if plan.kernel_params():
+        print("\tzswap is enabled by tmpfiles.d, or at boot with: {}".format(
+            ' '.join(plan.kernel_params())))
+
+    if plan.disk_size:
+        create_swap_file(target_dir, format_size(plan.disk_size))
+    write_config(plan, target_dir, os.path.join('/', SWAP_FILE))
+
 def _parse_args():
     from argparse import ArgumentParser
     parser = ArgumentParser(description="")
     parser.add_argument('target_dir')
+    parser.add_argument('-s', '--sync', action='store_true',
+            help="only copy new or changed files, and remove files gone "
+            "from the copied directories (not the files dropped from the "
+            "lists), e.g. when re-running after a failure")
+    parser.add_argument('--checksum', action='store_true',
+            help="with --sync, also compare file content by sha256")
+    parser.add_argument('--swap', choices=MODES, default='disk',
+            help="swap setup, compressed RAM (zram, zswap) is used before "
+            "the disk")
+    parser.add_argument('--swap-profile', choices=sorted(PROFILES),
+            default='desktop', help="sizes swap from the RAM for this use")
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+            help="number of steps run at the same time")
     args = parser.parse_args()
     return args
 
+def make_steps(target_dir, args):
+    copy_opts = {'sync': args.sync, 'checksum': args.checksum}
+    return [
+        Step(prefetch_base, early=True),
+        Step(partial(pacstrap, target_dir), deps=['prefetch_base']),
+        Step(partial(gen_fstab, target_dir), deps=['pacstrap']),
+        # after pacstrap, which sets the modes of /root and the like
+        Step(partial(copy_root_files, target_dir, ROOT_FILE_LIST,
+            **copy_opts), deps=['pacstrap']),
+        Step(fetch_config, prompt=confirm_config),
+        # after pacstrap, not to write to the package cache at the same time
+        Step(partial(prefetch_all, target_dir),
+            deps=['pacstrap', 'fetch_config']),
+        Step(partial(checkout_config, target_dir),
+            deps=['pacstrap', 'fetch_config']),
+        Step(partial(setup_swap, target_dir),
+            deps=['gen_fstab', 'checkout_config'],
+            prompt=partial(ask_swap_plan, args.swap, args.swap_profile)),
+        Step(partial(chroot, target_dir), interactive=True,
+            deps=['copy_root_files', 'checkout_config', 'setup_swap',
+                'prefetch_all']),
+        Step(partial(copy_user_files, target_dir, USER_FILE_LIST,
+            **copy_opts), deps=['chroot']),
+    ]
+
 def main():
     args = _parse_args()
     target_dir = os.path.abspath(args.target_dir)
 
-    pacstrap(target_dir)
-    gen_fstab(target_dir)
-    copy_root_files(target_dir, ROOT_FILE_LIST)
-    get_config(target_dir)
-    create_swap_file(target_dir)
-    chroot(target_dir)
-    copy_user_files(target_dir, USER_FILE_LIST)
+    TIMELINE.set_log(LOG_FILE)
+    # forked before the steps start threads, copy_user_files uses it
+    get_user_worker(DEFAULT_ADMIN_USER)
+    try:
+        # nothing to resume from, the state is not saved
+        run_steps(make_steps(target_dir, args), StepState(None),
+                max_workers=args.jobs)
+    finally:
+        TIMELINE.report(TRACE_FILE)
 
     print("Done.")
 
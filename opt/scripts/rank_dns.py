@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""Rank the upstream dns servers of unbound by latency.
+
+A mix of queries is sent concurrently to every forward-addr of the "."
+forward-zone in /etc/unbound/unbound.conf. The latency (p50 and p95), the
+loss and the number of wrong answers are measured. A wrong answer is a
+reply that does not match the query, a SERVFAIL/REFUSED, or an address
+returned for a name that does not exist (a sign of a hijacking resolver).
+
+The forward-zone is then rewritten with the servers in ranked order, and
+the failing ones commented out. With --apply, the running unbound is also
+updated with `unbound-control forward`, without a reload.
+"""
+import sys
+import re
+import random
+import struct
+import asyncio
+from time import monotonic, strftime
+
+from _utils import run, write_file
+
+
+UNBOUND_CONFIG_FILE = '/etc/unbound/unbound.conf'
+
+QUERY_NAMES = [
+    'www.baidu.com',
+    'www.qq.com',
+    'www.taobao.com',
+    'github.com',
+    'www.archlinux.org',
+    'www.wikipedia.org',
+    'www.google.com',
+    'www.youtube.com',
+]
+# the parent of the random names which must not exist
+NX_DOMAIN = 'invalid'
+
+RCODE_NOERROR = 0
+RCODE_NXDOMAIN = 3
+
+ZONE_RE = re.compile(r'^\s*forward-zone:\s*$')
+NAME_RE = re.compile(r'^\s*name:\s*"?([^"\s]+)"?\s*$')
+# also matches the servers dropped by an earlier run, so they are retried
+ADDR_RE = re.compile(r'^(\s*)#?\s*forward-addr:\s*(\S+)')
+RANKED_MARK = '# ranked by rank_dns.py'
+
+
+class Stats:
+    def __init__(self, server):
+        self.server = server
+        self.latencies = []
+        self.lost = 0
+        self.wrong = 0
+
+    @property
+    def sent(self):
+        return len(self.latencies) + self.lost + self.wrong
+
+    @property
+    def loss(self):
+        return self.lost / self.sent if self.sent else 1.0
+
+    def percentile(self, p):
+        if not self.latencies:
+            return float('inf')
+        values = sorted(self.latencies)
+        return values[min(int(p * len(values)), len(values) - 1)]
+
+    def describe(self):
+        return "p50 {:.0f} ms, p95 {:.0f} ms, loss {:.0%}, {} wrong".format(
+                self.percentile(0.5) * 1000, self.percentile(0.95) * 1000,
+                self.loss, self.wrong)
+
+
+def parse_server(addr):
+    """'1.2.3.4@5053' -> ('1.2.3.4', 5053)"""
+    host, _, port = addr.partition('@')
+    return host, int(port) if port else 53
+
+def build_query(name, qid, qtype=1):
+    header = struct.pack('!HHHHHH', qid, 0x0100, 1, 0, 0, 0)
+    qname = b''.join(bytes([len(label)]) + label.encode()
+            for label in name.rstrip('.').split('.')) + b'\0'
+    return header + qname + struct.pack('!HH', qtype, 1)
+
+def parse_reply(data):
+    """Returns (id, rcode, number of answers)."""
+    if len(data) < 12:
+        raise ValueError("short reply")
+    qid, flags, _, ancount, _, _ = struct.unpack('!HHHHHH', data[:12])
+    if not flags & 0x8000:
+        raise ValueError("not a reply")
+    return qid, flags & 0xf, ancount
+
+
+class _Query(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.reply = asyncio.get_running_loop().create_future()
+
+    def datagram_received(self, data, addr):
+        if not self.reply.done():
+            self.reply.set_result(data)
+
+    def error_received(self, exc):
+        if not self.reply.done():
+            self.reply.set_exception(exc)
+
+async def query(server, name, timeout):
+    """Send one query, returns (latency, rcode, answers)."""
+    loop = asyncio.get_running_loop()
+    host, port = parse_server(server)
+    qid = random.randrange(1 << 16)
+    transport, protocol = await loop.create_datagram_endpoint(_Query,
+            remote_addr=(host, port))
+    try:
+        start = monotonic()
+        transport.sendto(build_query(name, qid))
+        data = await asyncio.wait_for(protocol.reply, timeout)
+        latency = monotonic() - start
+    finally:
+        transport.close()
+    reply_id, rcode, answers = parse_reply(data)
+    if reply_id != qid:
+        raise ValueError("id mismatch")
+    return latency, rcode, answers
+
+async def benchmark(servers, names=QUERY_NAMES, rounds=3, concurrency=32,
+        timeout=2.0):
+    """Query every server, returns {server: Stats}."""
+    sem = asyncio.Semaphore(concurrency)
+    stats = {server: Stats(server) for server in servers}
+
+    async def _one(server, name, must_not_exist):
+        async with sem:
+            s = stats[server]
+            try:
+                latency, rcode, answers = await query(server, name, timeout)
+            except asyncio.TimeoutError:
+                s.lost += 1
+                return
+            except (OSError, ValueError):
+                s.wrong += 1
+                return
+            if must_not_exist:
+                ok = rcode == RCODE_NXDOMAIN and answers == 0
+            else:
+                ok = rcode in (RCODE_NOERROR, RCODE_NXDOMAIN)
+            if ok:
+                s.latencies.append(latency)
+            else:
+                s.wrong += 1
+
+    jobs = []
+    for _ in range(rounds):
+        nx_name = 'x{:08x}.{}'.format(random.randrange(1 << 32), NX_DOMAIN)
+        for server in servers:
+            for name in names:
+                jobs.append(_one(server, name, False))
+            jobs.append(_one(server, nx_name, True))
+    random.shuffle(jobs)
+    await asyncio.gather(*jobs)
+    return stats
+
+def rank(stats, max_loss):
+    """Returns (good, bad) lists of Stats, good ones best first."""
+    good = [s for s in stats.values()
+            if s.latencies and s.wrong == 0 and s.loss <= max_loss]
+    bad = [s for s in stats.values() if s not in good]
+    good.sort(key=lambda s: (s.percentile(0.5), s.percentile(0.95)))
+    return good, bad
+
+def _find_zone(lines, zone):
+    """Returns the (start, end) line indexes of a forward-zone block."""
+    i = 0
+    while i < len(lines):
+        if ZONE_RE.match(lines[i]):
+            end = i + 1
+            while end < len(lines) and (lines[end].startswith((' ', '\t'))
+                    and lines[end].strip()):
+                end += 1
+            for line in lines[i + 1:end]:
+                match = NAME_RE.match(line)
+                if match and match.group(1) == zone:
+                    return i, end
+            i = end
+        else:
+            i += 1
+    return None
+
+def read_forward_addrs(path, zone='.'):
+    with open(path) as f:
+        lines = f.read().splitlines()
+    found = _find_zone(lines, zone)
+    if found is None:
+        return []
+    start, end = found
+    return [m.group(2) for m in map(ADDR_RE.match, lines[start:end]) if m]
+
+def rewrite_forward_zone(text, good, bad, zone='.'):
+    lines = text.splitlines()
+    found = _find_zone(lines, zone)
+    if found is None:
+        raise ValueError("no forward-zone for {}".format(zone))
+    start, end = found
+    block = lines[start:end]
+    indent = '  '
+    for line in block:
+        match = ADDR_RE.match(line)
+        if match:
+            indent = match.group(1)
+            break
+    kept = [line for line in block if not ADDR_RE.match(line)
+            and not line.strip().startswith(RANKED_MARK)]
+    new_block = kept + ["{}{} at {}".format(
+        indent, RANKED_MARK, strftime('%Y-%m-%d %H:%M:%S'))]
+    for s in good:
+        new_block.append("{}forward-addr: {}".format(indent, s.server))
+    for s in bad:
+        new_block.append("{}#forward-addr: {}  # dropped: {}".format(
+            indent, s.server, s.describe()))
+    lines[start:end] = new_block
+    return '\n'.join(lines) + '\n'
+
+def apply_forwarders(good):
+    print("Updating forwarders of the running unbound...")
+    run(['unbound-control', 'forward', *(s.server for s in good)])
+
+def _parse_args():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description="")
+    parser.add_argument('config', nargs='?', default=UNBOUND_CONFIG_FILE)
+    parser.add_argument('-r', '--rounds', type=int, default=3,
+            help="times the query mix is sent to every server")
+    parser.add_argument('-c', '--concurrency', type=int, default=32,
+            help="number of queries in flight")
+    parser.add_argument('-t', '--timeout', type=float, default=2.0,
+            help="timeout of one query in seconds")
+    parser.add_argument('--max-loss', type=float, default=0.2,
+            help="drop servers losing more than this fraction of queries")
+    parser.add_argument('-a', '--apply', action='store_true',
+            help="also apply the result with unbound-control")
+    parser.add_argument('--dry-run', action='store_true',
+            help="print the new config instead of writing it")
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = _parse_args()
+    servers = read_forward_addrs(args.config)
+    if not servers:
+        sys.exit("No forward-addr found in {}.".format(args.config))
+
+    print("Benchmarking {} servers...".format(len(servers)))
+    stats = asyncio.run(benchmark(servers, rounds=args.rounds,
+        concurrency=args.concurrency, timeout=args.timeout))
+    good, bad = rank(stats, args.max_loss)
+    for s in good + bad:
+        print("\t{}: {}{}".format(s.server, s.describe(),
+            '' if s in good else ' (dropped)'))
+    if not good:
+        sys.exit("All servers failed, {} not changed.".format(args.config))
+
+    with open(args.config) as f:
+        content = rewrite_forward_zone(f.read(), good, bad)
+    if args.dry_run:
+        print(content, end='')
+        return
+    write_file(args.config, content, backup=True)
+    print("{} updated.".format(args.config))
+    if args.apply:
+        apply_forwarders(good)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""Rank the servers in /etc/pacman.d/mirrorlist by speed.
+
+Every server, including the commented out ones, is probed concurrently:
+the connect latency is measured, then a sample of a database file is
+downloaded to measure the throughput. The mirrorlist is then rewritten
+with the fastest servers first, the others are kept but commented out.
+"""
+import sys
+import re
+import ssl
+import asyncio
+import platform
+from time import monotonic, strftime
+from urllib.parse import urlsplit, urljoin
+
+from _utils import write_file
+
+
+MIRRORLIST_FILE = '/etc/pacman.d/mirrorlist'
+# the file downloaded from every server, larger than SAMPLE_BYTES (about
+# 8 MiB, core.db is only ~150 KiB), so that the sample measures more
+# than the tcp slow start
+SAMPLE_REPO = 'extra'
+SAMPLE_FILE = 'extra.db'
+SAMPLE_BYTES = 2 * 1024 * 1024
+# snapshot mirrors should never be enabled automatically
+DEFAULT_EXCLUDE = 'archive.archlinux.org'
+
+SERVER_RE = re.compile(r'^\s*(#)?\s*Server\s*=\s*(\S+)')
+
+
+class ProbeError(Exception):
+    pass
+
+
+class Result:
+    def __init__(self, server, latency=None, throughput=None, error=None):
+        self.server = server
+        self.latency = latency
+        self.throughput = throughput
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def describe(self):
+        if not self.ok:
+            return "failed: {}".format(self.error)
+        return "{:.0f} ms, {:.2f} MiB/s".format(
+                self.latency * 1000, self.throughput / 2**20)
+
+
+def read_servers(path):
+    servers = []
+    with open(path) as f:
+        for line in f:
+            match = SERVER_RE.match(line)
+            if match and match.group(2) not in servers:
+                servers.append(match.group(2))
+    return servers
+
+def sample_url(server, arch=None):
+    arch = arch or platform.machine()
+    url = server.replace('$repo', SAMPLE_REPO).replace('$arch', arch)
+    return url.rstrip('/') + '/' + SAMPLE_FILE
+
+async def _open(url):
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https'):
+        raise ProbeError("unsupported scheme {}".format(parts.scheme))
+    https = parts.scheme == 'https'
+    port = parts.port or (443 if https else 80)
+    ctx = ssl.create_default_context() if https else None
+    reader, writer = await asyncio.open_connection(parts.hostname, port,
+            ssl=ctx)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    request = ("GET {} HTTP/1.1\r\nHost: {}\r\nUser-Agent: rank_mirrors\r\n"
+            "Connection: close\r\n\r\n").format(path, parts.netloc)
+    writer.write(request.encode())
+    return reader, writer
+
+async def _read_headers(reader):
+    status = await reader.readline()
+    try:
+        code = int(status.split()[1])
+    except (IndexError, ValueError):
+        raise ProbeError("bad response {!r}".format(status[:40]))
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+    return code, headers
+
+async def probe(server, sample_bytes=SAMPLE_BYTES, arch=None):
+    """Return (connect latency, throughput in bytes/s) of server."""
+    url = sample_url(server, arch)
+    for _ in range(3):
+        start = monotonic()
+        reader, writer = await _open(url)
+        latency = monotonic() - start
+        try:
+            code, headers = await _read_headers(reader)
+            if code in (301, 302, 303, 307, 308) and 'location' in headers:
+                url = urljoin(url, headers['location'])
+                continue
+            if code != 200:
+                raise ProbeError("HTTP {}".format(code))
+            start = monotonic()
+            received = 0
+            while received < sample_bytes:
+                data = await reader.read(64 * 1024)
+                if not data:
+                    break
+                received += len(data)
+            elapsed = max(monotonic() - start, 1e-6)
+            if received == 0:
+                raise ProbeError("empty response")
+            return latency, received / elapsed
+        finally:
+            writer.close()
+    raise ProbeError("too many redirects")
+
+async def rank(servers, concurrency=8, timeout=10, **kwargs):
+    """Probe all servers, returns the results, best first."""
+    sem = asyncio.Semaphore(concurrency)
+
+    async def _probe(server):
+        async with sem:
+            try:
+                latency, throughput = await asyncio.wait_for(
+                        probe(server, **kwargs), timeout)
+                return Result(server, latency, throughput)
+            except asyncio.TimeoutError:
+                return Result(server, error="timed out")
+            except (OSError, ProbeError) as e:
+                return Result(server, error=str(e) or type(e).__name__)
+
+    results = await asyncio.gather(*(_probe(s) for s in servers))
+    good = sorted((r for r in results if r.ok),
+            key=lambda r: (-r.throughput, r.latency))
+    bad = [r for r in results if not r.ok]
+    return good + bad
+
+def format_mirrorlist(results, top, excluded=()):
+    lines = ["# Ranked by rank_mirrors.py at {}".format(
+        strftime('%Y-%m-%d %H:%M:%S'))]
+    for i, r in enumerate(results):
+        lines.append("# {}".format(r.describe()))
+        prefix = '' if r.ok and i < top else '# '
+        lines.append("{}Server = {}".format(prefix, r.server))
+    for server in excluded:
+        lines.append("# excluded")
+        lines.append("# Server = {}".format(server))
+    return '\n'.join(lines) + '\n'
+
+def _parse_args():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description="")
+    parser.add_argument('mirrorlist', nargs='?', default=MIRRORLIST_FILE)
+    parser.add_argument('-c', '--concurrency', type=int, default=8,
+            help="number of servers probed at the same time")
+    parser.add_argument('-t', '--timeout', type=float, default=10,
+            help="timeout in seconds for probing one server")
+    parser.add_argument('-n', '--top', type=int, default=3,
+            help="number of servers to enable")
+    parser.add_argument('-e', '--exclude', default=DEFAULT_EXCLUDE,
+            help="regex of servers not to probe")
+    parser.add_argument('--dry-run', action='store_true',
+            help="print the new mirrorlist instead of writing it")
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = _parse_args()
+    servers = read_servers(args.mirrorlist)
+    excluded = []
+    if args.exclude:
+        excluded = [s for s in servers if re.search(args.exclude, s)]
+        servers = [s for s in servers if s not in excluded]
+    if not servers:
+        sys.exit("No servers found in {}.".format(args.mirrorlist))
+
+    print("Probing {} servers...".format(len(servers)))
+    results = asyncio.run(rank(servers, args.concurrency, args.timeout))
+    for r in results:
+        print("\t{}: {}".format(r.server, r.describe()))
+    if not any(r.ok for r in results):
+        sys.exit("All servers failed, {} not changed.".format(
+            args.mirrorlist))
+
+    content = format_mirrorlist(results, args.top, excluded)
+    if args.dry_run:
+        print(content, end='')
+    else:
+        write_file(args.mirrorlist, content, backup=True)
+        print("{} updated.".format(args.mirrorlist))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""Select the I/O scheduler of each class of disk by benchmarking.
+
+Every disk is classified as nvme, usb (USB and SD cards), emmc
+(internal flash), rotational or ssd. Each scheduler the kernel offers
+(mq-deadline, bfq, kyber, none) is then benchmarked with a mixed
+workload: random 4 KiB reads from several threads while a sequential
+reader streams 1 MiB blocks. The workload only reads, with O_DIRECT, so
+it is safe on disks in use.
+
+The winner of a class is the scheduler with the lowest p99 latency of the
+random reads, among the ones keeping at least MIN_SEQ_FRACTION of the
+best sequential throughput. A udev rules file is generated with the
+winner of every class (the defaults for classes with no disk here), and
+the scheduler tunables that exist for it.
+"""
+import sys
+import os
+import re
+import mmap
+import random
+import threading
+from time import monotonic
+
+from _utils import run, write_file
+
+
+RULES_FILE = '/etc/udev/rules.d/60-disk-scheduler.rules'
+
+SCHEDULERS = ['mq-deadline', 'bfq', 'kyber', 'none']
+CLASSES = ['rotational', 'ssd', 'nvme', 'usb', 'emmc']
+
+# used for the classes not benchmarked
+DEFAULT_SCHEDULERS = {
+    'rotational': 'bfq',
+    'ssd': 'mq-deadline',
+    'nvme': 'none',
+    'usb': 'bfq',
+    'emmc': 'mq-deadline',
+}
+
+# udev matches of the classes, usb and emmc last so that they override the
+# others, and emmc the mmc match of usb
+CLASS_MATCHES = {
+    'rotational': 'KERNEL=="sd[a-z]*|vd[a-z]*", ATTR{queue/rotational}=="1"',
+    'ssd': 'KERNEL=="sd[a-z]*|vd[a-z]*", ATTR{queue/rotational}=="0"',
+    'nvme': 'KERNEL=="nvme[0-9]*n[0-9]*"',
+    'usb': 'KERNEL=="sd[a-z]*|mmcblk[0-9]*", SUBSYSTEMS=="usb|mmc"',
+    'emmc': 'KERNEL=="mmcblk[0-9]*", ATTRS{type}=="MMC"',
+}
+
+# tunables in queue/iosched/, only written if the scheduler has them;
+# the short sync and long async deadlines of the old cfq rule are kept
+TUNABLES = {
+    ('bfq', 'rotational'): {
+        'low_latency': 1,
+        'fifo_expire_sync': 150,
+        'fifo_expire_async': 1500,
+    },
+    ('bfq', 'usb'): {
+        'low_latency': 1,
+        'fifo_expire_sync': 150,
+        'fifo_expire_async': 1500,
+    },
+    ('bfq', 'ssd'): {
+        'low_latency': 1,
+        'slice_idle': 0,
+    },
+    ('mq-deadline', 'rotational'): {
+        'read_expire': 150,
+        'write_expire': 1500,
+    },
+    ('mq-deadline', 'usb'): {
+        'read_expire': 150,
+        'write_expire': 1500,
+    },
+}
+
+BLOCK_SIZE = 4096
+SEQ_BLOCK_SIZE = 1024 * 1024
+RANDOM_THREADS = 4
+DURATION = 10
+MIN_SEQ_FRACTION = 0.8
+
+SCHEDULER_RE = re.compile(r'\[?([\w-]+)\]?')
+
+
+def _sys_path(dev, *parts):
+    return os.path.join('/sys/block', dev, *parts)
+
+def _read(path):
+    with open(path) as f:
+        return f.read().strip()
+
+def _write(path, value):
+    with open(path, 'w') as f:
+        f.write(str(value))
+
+def schedulers(dev):
+    """Returns (available schedulers, current one)."""
+    text = _read(_sys_path(dev, 'queue/scheduler'))
+    current = re.search(r'\[([\w-]+)\]', text)
+    return (SCHEDULER_RE.findall(text),
+            current.group(1) if current else None)
+
+def set_scheduler(dev, scheduler):
+    _write(_sys_path(dev, 'queue/scheduler'), scheduler)
+
+def classify(dev):
+    if dev.startswith('nvme'):
+        return 'nvme'
+    if dev.startswith('mmcblk'):
+        # MMC for soldered eMMC, SD for cards
+        try:
+            type_ = _read(_sys_path(dev, 'device/type'))
+        except OSError:
+            type_ = None
+        return 'emmc' if type_ == 'MMC' else 'usb'
+    # the device link goes through the usb host
+    device = os.path.realpath(_sys_path(dev, 'device'))
+    if '/usb' in device:
+        return 'usb'
+    if _read(_sys_path(dev, 'queue/rotational')) == '1':
+        return 'rotational'
+    return 'ssd'
+
+def list_disks():
+    """The disks with a choice of schedulers."""
+    disks = []
+    for dev in sorted(os.listdir('/sys/block')):
+        if dev.startswith(('loop', 'ram', 'zram', 'dm-', 'md', 'sr')):
+            continue
+        try:
+            available, _ = schedulers(dev)
+        except OSError:
+            continue
+        if len(available) > 1:
+            disks.append(dev)
+    return disks
+
+def percentile(values, p):
+    if not values:
+        return float('inf')
+    values = sorted(values)
+    return values[min(int(p * len(values)), len(values) - 1)]
+
+
+class Result:
+    def __init__(self, scheduler, latencies, seq_bytes, elapsed):
+        self.scheduler = scheduler
+        self.latencies = latencies
+        self.iops = len(latencies) / elapsed
+        self.throughput = seq_bytes / elapsed
+
+    @property
+    def p99(self):
+        return percentile(self.latencies, 0.99)
+
+    def describe(self):
+        return "{:.0f} iops, p99 {:.1f} ms, seq {:.0f} MiB/s".format(
+                self.iops, self.p99 * 1000, self.throughput / 2**20)
+
+
+def benchmark(dev, scheduler, duration=DURATION, seed=0):
+    """Run the mixed read workload on dev with scheduler."""
+    set_scheduler(dev, scheduler)
+    size = int(_read(_sys_path(dev, 'size'))) * 512
+    fd = os.open(os.path.join('/dev', dev), os.O_RDONLY | os.O_DIRECT)
+    stop = threading.Event()
+    latencies = []
+    seq_bytes = [0]
+
+    def _random(n):
+        rng = random.Random(seed + n)
+        # O_DIRECT needs aligned buffers, mmap ones are
+        buf = mmap.mmap(-1, BLOCK_SIZE)
+        blocks = size // BLOCK_SIZE
+        while not stop.is_set():
+            offset = rng.randrange(blocks) * BLOCK_SIZE
+            start = monotonic()
+            os.preadv(fd, [buf], offset)
+            latencies.append(monotonic() - start)
+
+    def _sequential():
+        buf = mmap.mmap(-1, SEQ_BLOCK_SIZE)
+        offset = 0
+        while not stop.is_set():
+            if offset + SEQ_BLOCK_SIZE > size:
+                offset = 0
+            seq_bytes[0] += os.preadv(fd, [buf], offset)
+            offset += SEQ_BLOCK_SIZE
+
+    threads = [threading.Thread(target=_random, args=(n,))
+            for n in range(RANDOM_THREADS)]
+    threads.append(threading.Thread(target=_sequential))
+    start = monotonic()
+    try:
+        for t in threads:
+            t.start()
+        stop.wait(duration)
+    finally:
+        stop.set()
+        for t in threads:
+            t.join()
+        os.close(fd)
+    return Result(scheduler, latencies, seq_bytes[0], monotonic() - start)
+
+def pick(results):
+    best_seq = max(r.throughput for r in results)
+    good = [r for r in results if r.throughput >= best_seq * MIN_SEQ_FRACTION]
+    return min(good, key=lambda r: r.p99)
+
+def valid_tunables(dev, scheduler, class_):
+    """The tunables of TUNABLES existing for the current scheduler."""
+    tunables = TUNABLES.get((scheduler, class_), {})
+    return {k: v for k, v in tunables.items()
+            if os.path.exists(_sys_path(dev, 'queue/iosched', k))}
+
+def format_rules(winners):
+    """winners is {class: (scheduler, tunables)}."""
+    lines = ["# Generated by select_io_scheduler.py."]
+    for class_ in CLASSES:
+        scheduler, tunables = winners.get(class_,
+                (DEFAULT_SCHEDULERS[class_],
+                    TUNABLES.get((DEFAULT_SCHEDULERS[class_], class_), {})))
+        attrs = ['ATTR{{queue/scheduler}}="{}"'.format(scheduler)]
+        attrs += ['ATTR{{queue/iosched/{}}}="{}"'.format(k, v)
+                for k, v in tunables.items()]
+        lines.append("# {}".format(class_))
+        lines.append('ACTION=="add|change", ENV{{DEVTYPE}}=="disk", {}, {}'
+                .format(CLASS_MATCHES[class_], ', '.join(attrs)))
+    return '\n'.join(lines) + '\n'
+
+def _parse_args():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description="")
+    parser.add_argument('devices', nargs='*',
+            help="e.g. sda nvme0n1 (default: all disks), loop and null_blk "
+            "devices can be given for testing")
+    parser.add_argument('-d', '--duration', type=float, default=DURATION,
+            help="seconds of benchmark per scheduler")
+    parser.add_argument('-o', '--output', default=RULES_FILE)
+    parser.add_argument('-a', '--apply', action='store_true',
+            help="reload the udev rules and apply them to the disks")
+    parser.add_argument('--dry-run', action='store_true',
+            help="print the rules instead of writing them")
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = _parse_args()
+    if os.geteuid() != 0:
+        sys.exit("Disks can only be benchmarked by root.")
+    devices = args.devices or list_disks()
+    if not devices:
+        sys.exit("No disk found.")
+
+    winners = {}
+    for dev in devices:
+        class_ = classify(dev)
+        available, original = schedulers(dev)
+        print("Benchmarking {} ({})...".format(dev, class_))
+        results = []
+        try:
+            for scheduler in SCHEDULERS:
+                if scheduler not in available:
+                    continue
+                result = benchmark(dev, scheduler, args.duration)
+                print("\t{}: {}".format(scheduler, result.describe()))
+                results.append(result)
+            if not results:
+                print("\tnone of {} available, skipping".format(
+                    ', '.join(SCHEDULERS)))
+                continue
+            best = pick(results)
+            set_scheduler(dev, best.scheduler)
+            tunables = valid_tunables(dev, best.scheduler, class_)
+        finally:
+            if original:
+                set_scheduler(dev, original)
+        print("\tbest: {}".format(best.scheduler))
+        # the first disk of a class decides
+        winners.setdefault(class_, (best.scheduler, tunables))
+
+    content = format_rules(winners)
+    if args.dry_run:
+        print(content, end='')
+        return
+    write_file(args.output, content)
+    print("{} written.".format(args.output))
+    if args.apply:
+        run(['udevadm', 'control', '--reload'])
+        run(['udevadm', 'trigger', '--subsystem-match=block',
+            '--action=change'])
+
+
+if __name__ == '__main__':
+    main()
@@ -14,9 +14,53 @@ this script. The configuration format is like the following:
     password = 
     prompt = 
 
+With --pool, all the vps sections are used instead of [current]. The
+latency to each vps is measured in the background, and the tunnel goes to
+the fastest one. When it degrades, it is switched to the next one at
+once, and the vps that failed is ranked last for FAILOVER_COOLDOWN. The
+ranking only decides where a tunnel goes when it is (re)started, a
+healthy tunnel is not moved. The latency history is kept in HISTORY_FILE
+across restarts.
+
+With --backends N, N tunnels are started on the ports from BACKEND_PORT
+on, and LOCAL_PORT is served by a built-in front-end which spreads new
+connections over the healthy tunnels. A degraded tunnel gets no new
+connections, and is restarted once its connections are finished.
+
+With --standby, one more tunnel is kept authenticated but unused. When a
+tunnel degrades, the front-end switches to the standby at once (if the
+data path through it passes the check), and the degraded tunnel is
+rebuilt in the background as the new standby, once its connections are
+finished. The idle standby is checked too, and rebuilt if it fails. In
+pool mode the standby goes to a different vps than the active tunnel if
+possible.
+
+Metrics (check rtt histogram, spawn results, restarts, uptime and time to
+ready) can be written to a file with --metrics-file, or served over http
+with --metrics-port, in the Prometheus text format. A summary is also
+shown by `systemctl status vps-proxy`.
+
+Besides checking the ssh shell, the forwarding itself is checked by
+connecting to a target through the socks port. The target can be set in
+an optional section (defaults shown):
+
+    [check]
+    host = www.gstatic.com
+    port = 80
+    # http or echo
+    mode = http
+    path = /generate_204
+    # reconnect if the round trip takes longer than this, in seconds
+    max_rtt = 2.0
+
 """
 import configparser
-from time import sleep
+import json
+import socket
+import threading
+import statistics
+from time import sleep, monotonic, time
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
 from functools import partial
 import sys
@@ -26,6 +70,10 @@ import platform
 
 import pexpect
 
+from _socks import probe, SocksError, Backend, SocksBalancer
+from _metrics import Registry
+from _utils import write_file
+
 LINUX = platform.system() == 'Linux'
 if LINUX:
     import systemd.daemon
@@ -34,9 +82,58 @@ if LINUX:
 LOCAL_PORT = 8088
 CONNECT_TIMEOUT = 20
 TEST_TIMEOUT = 3
+CHECK_INTERVAL = 6
+# reconnect after this many failed checks in a row
+MAX_BAD_COUNT = 3
+# reconnect after this many checks in a row slower than max_rtt
+MAX_SLOW_COUNT = 2
+
+CHECK_DEFAULTS = {
+    'host': 'www.gstatic.com',
+    'port': '80',
+    'mode': 'http',
+    'path': '/generate_204',
+    'max_rtt': '2.0',
+}
 
 CONFIG_FILE = os.path.expanduser('~/.vps-proxy')
+HISTORY_FILE = os.path.expanduser('~/.cache/vps-proxy/latency.json')
+
+# sections of CONFIG_FILE that are not vps
+SPECIAL_SECTIONS = ['current', 'check']
+
+# pool mode
+POOL_CHECK_INTERVAL = 2
+POOL_MAX_BAD_COUNT = 2
+RANK_INTERVAL = 30
+HISTORY_SIZE = 20
+# a vps which just failed is ranked last for this long
+FAILOVER_COOLDOWN = 300
 
+# backends mode
+BACKEND_PORT = 18088
+DRAIN_TIMEOUT = 10
+
+
+METRICS = Registry()
+CHECK_RTT = METRICS.histogram('vps_proxy_check_rtt_seconds',
+        "Round trip time of the checks through the socks port.",
+        [0.05, 0.1, 0.2, 0.5, 1, 2, 5])
+CHECKS = METRICS.counter('vps_proxy_checks_total',
+        "Checks of the tunnel, by result.")
+SPAWNS = METRICS.counter('vps_proxy_spawns_total',
+        "Attempts to start the ssh tunnel, by result.")
+RESTARTS = METRICS.counter('vps_proxy_restarts_total',
+        "Restarts of the tunnel, by reason.")
+UP_SINCE = METRICS.gauge('vps_proxy_tunnel_up_since_seconds',
+        "Unix time at which the current tunnel became ready.")
+UPTIME = METRICS.gauge('vps_proxy_tunnel_uptime_seconds',
+        "Time since the current tunnel became ready.")
+TIME_TO_READY = METRICS.gauge('vps_proxy_time_to_ready_seconds',
+        "Time it took to start the current tunnel, including retries.")
+
+# results of spawn_tunnel, by the index returned by expect()
+SPAWN_RESULTS = ['ready', 'host_key', 'unreachable', 'eof']
 
 print_err = partial(print, file=sys.stderr, flush=True)
 print = partial(print, flush=True)
@@ -59,47 +156,75 @@ def read_config():
     vps_config['prompt'] = _sanitize(vps_config['prompt'])
     return vps_config
 
-def start_tunnel(config):
+def read_pool_config():
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+    pool = []
+    for name in config.sections():
+        if name in SPECIAL_SECTIONS:
+            continue
+        vps_config = config[name]
+        vps_config.setdefault('port', '22')
+        vps_config['prompt'] = _sanitize(vps_config['prompt'])
+        pool.append(vps_config)
+    return pool
+
+def read_check_config():
+    config = configparser.ConfigParser()
+    config.read_dict({'check': CHECK_DEFAULTS})
+    config.read(CONFIG_FILE)
+    return config['check']
+
+def spawn_tunnel(config, local_port=LOCAL_PORT):
+    """Try to start the tunnel once, returns None on failure."""
     cmd = 'ssh -C -o ControlMaster=no -D {local_port} -p {port} {user}@{host}'
-    cmd = cmd.format(local_port=LOCAL_PORT,
+    cmd = cmd.format(local_port=local_port,
         port=config['port'],
         user=config['user'],
         host=config['host']
     )
 
+    print("Spawning tunnel to {}...".format(config.name))
+    ssh_tunnel = pexpect.spawnu(cmd, timeout=CONNECT_TIMEOUT)
+    try:
+        index = ssh_tunnel.expect([
+            'password:',
+            '\(yes/no\)',
+            'Network is unreachable',
+            pexpect.EOF])
+        if index == 0:
+            print("Authenticating...")
+            ssh_tunnel.sendline(config['password'])
+            print("Waiting for shell prompt...")
+            ssh_tunnel.expect(config['prompt'])
+            print("Tunnel ready.")
+            SPAWNS.inc(port=local_port, result=SPAWN_RESULTS[index])
+            return ssh_tunnel
+        SPAWNS.inc(port=local_port, result=SPAWN_RESULTS[index])
+        if index == 1:
+            sys.exit("Unknown host key. Please connect with {cmd} manually to "
+                    "verify the fingerprint.".format(cmd=cmd))
+        elif index == 2:
+            print_err("Network is unreachable.")
+        elif index == 3:
+            print_err("Unexpected error:")
+            print_err(ssh_tunnel.before.rstrip())
+    except pexpect.TIMEOUT:
+        SPAWNS.inc(port=local_port, result='timeout')
+        print_err("Timed out.")
+        #print_err(ssh_tunnel.before.strip())
+    finally:
+        gc.collect()
+    shutdown_tunnel(ssh_tunnel)
+    return None
+
+def start_tunnel(config, local_port=LOCAL_PORT):
     while True:
-        print("Spawning tunnel...")
-        ssh_tunnel = pexpect.spawnu(cmd, timeout=CONNECT_TIMEOUT)
-        try:
-            index = ssh_tunnel.expect([
-                'password:',
-                '\(yes/no\)',
-                'Network is unreachable',
-                pexpect.EOF])
-            if index == 0:
-                print("Authenticating...")
-                ssh_tunnel.sendline(config['password'])
-                print("Waiting for shell prompt...")
-                ssh_tunnel.expect(config['prompt'])
-                print("Tunnel ready.")
-                return ssh_tunnel
-            elif index == 1:
-                sys.exit("Unknown host key. Please connect with {cmd} manually to "
-                        "verify the fingerprint.".format(cmd=cmd))
-            elif index == 2:
-                print_err("Network is unreachable. Retry in 10s.")
-                sleep(10)
-            elif index == 3:
-                print_err("Unexpected error:")
-                print_err(ssh_tunnel.before.rstrip())
-                print_err("Retry in 10s.")
-                sleep(10)
-        except pexpect.TIMEOUT:
-            print_err("Timed out. Retry in 10s.")
-            #print_err(ssh_tunnel.before.strip())
-            sleep(10)
-        finally:
-            gc.collect()
+        ssh_tunnel = spawn_tunnel(config, local_port)
+        if ssh_tunnel is not None:
+            return ssh_tunnel
+        print_err("Retry in 10s.")
+        sleep(10)
 
 def test_tunnel(ssh_tunnel, config):
     ssh_tunnel.sendline()
@@ -109,29 +234,422 @@ def test_tunnel(ssh_tunnel, config):
     except pexpect.TIMEOUT:
         return False
 
+def probe_tunnel(check, local_port=LOCAL_PORT):
+    """Check the data path through the socks port.
+
+    Returns the ProbeResult, or None if the target cannot be reached.
+    """
+    try:
+        return probe(('127.0.0.1', local_port), check['host'],
+                check.getint('port'), mode=check['mode'], path=check['path'],
+                timeout=TEST_TIMEOUT)
+    except (OSError, SocksError) as e:
+        print_err("Probe through socks port failed: {}".format(e))
+        return None
+
 def shutdown_tunnel(ssh_tunnel):
     ssh_tunnel.terminate(force=True)
 
-def run():
-    config = read_config()
-    ssh_tunnel = start_tunnel(config)
-    if LINUX:
-        systemd.daemon.notify('READY=1')
+def connect_latency(config, timeout=TEST_TIMEOUT):
+    """Time to open a tcp connection to the ssh port, None on failure."""
+    start = monotonic()
+    try:
+        with socket.create_connection((config['host'],
+                int(config['port'])), timeout=timeout):
+            return monotonic() - start
+    except OSError:
+        return None
+
+
+class VPSPool:
+    """The configured vps, ranked by their recent connect latency."""
+    def __init__(self, configs, history_file=HISTORY_FILE):
+        self.configs = {c.name: c for c in configs}
+        self.history_file = history_file
+        self._lock = threading.Lock()
+        try:
+            with open(history_file) as f:
+                history = json.load(f)
+        except (FileNotFoundError, ValueError):
+            history = {}
+        self.history = {name: history.get(name, []) for name in self.configs}
+        self.failed_at = {}
+
+    def add_sample(self, name, latency):
+        with self._lock:
+            samples = self.history[name]
+            samples.append(latency)
+            del samples[:-HISTORY_SIZE]
+
+    def score(self, name):
+        with self._lock:
+            samples = self.history[name][-5:]
+        if not samples:
+            return float('inf')
+        # a failure counts as a very slow sample
+        values = [x if x is not None else 60.0 for x in samples]
+        return statistics.median(values)
+
+    def demote(self, name):
+        """Rank name last for FAILOVER_COOLDOWN.
+
+        One failure hardly moves the median of score, this does.
+        """
+        self.add_sample(name, None)
+        with self._lock:
+            self.failed_at[name] = monotonic()
+
+    def _cooling_down(self, name):
+        with self._lock:
+            failed_at = self.failed_at.get(name)
+        return (failed_at is not None
+                and monotonic() - failed_at < FAILOVER_COOLDOWN)
+
+    def ranked(self):
+        return sorted(self.configs,
+                key=lambda name: (self._cooling_down(name), self.score(name)))
 
+    def measure(self):
+        names = list(self.configs)
+        with ThreadPoolExecutor(max_workers=len(names)) as pool:
+            latencies = pool.map(lambda n: connect_latency(self.configs[n]),
+                    names)
+            for name, latency in zip(names, latencies):
+                self.add_sample(name, latency)
+        self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.history_file), exist_ok=True)
+        with self._lock:
+            content = json.dumps(self.history)
+        write_file(self.history_file, content, sync=False)
+
+    def start_ranking(self, interval=RANK_INTERVAL):
+        def _loop():
+            while True:
+                sleep(interval)
+                self.measure()
+        threading.Thread(target=_loop, daemon=True).start()
+
+    def start_tunnel(self, local_port=LOCAL_PORT, avoid=()):
+        """Start the tunnel to the best vps that works.
+
+        The vps in avoid are only used if no other one works. Returns
+        (ssh_tunnel, config).
+        """
+        if all(not h for h in self.history.values()):
+            print("No latency history, measuring...")
+            self.measure()
+        while True:
+            ranked = self.ranked()
+            ranked.sort(key=lambda name: name in avoid)
+            for name in ranked:
+                ssh_tunnel = spawn_tunnel(self.configs[name], local_port)
+                if ssh_tunnel is not None:
+                    return ssh_tunnel, self.configs[name]
+                self.add_sample(name, None)
+            print_err("No vps available. Retry in 10s.")
+            sleep(10)
+            self.measure()
+
+class Tunnel:
+    """One ssh tunnel, restarted when it degrades."""
+    def __init__(self, local_port, config=None, pool=None):
+        self.local_port = local_port
+        self.config = config
+        self.pool = pool
+        self.ssh_tunnel = None
+        self.ready_at = None
+
+    def start(self, avoid=()):
+        start = monotonic()
+        if self.pool is not None:
+            self.ssh_tunnel, self.config = self.pool.start_tunnel(
+                    self.local_port, avoid)
+        else:
+            self.ssh_tunnel = start_tunnel(self.config, self.local_port)
+        self.ready_at = monotonic()
+        TIME_TO_READY.set(round(self.ready_at - start, 3),
+                port=self.local_port)
+        UP_SINCE.set(round(time()), port=self.local_port)
+
+    def uptime(self):
+        return monotonic() - self.ready_at
+
+    def restart(self, avoid=()):
+        shutdown_tunnel(self.ssh_tunnel)
+        if self.pool is not None:
+            # make sure the next best one is chosen
+            self.pool.demote(self.config.name)
+            avoid = [*avoid, self.config.name]
+        self.start(avoid)
+
+
+class Standby:
+    """A spare tunnel, authenticated and ready to replace a degraded one.
+
+    The standby backend is kept unhealthy, so that the front-end does not
+    use it until it is promoted. It is promoted only if the data path
+    through it passes check, which is also run on the idle standby; a
+    standby failing it is rebuilt.
+    """
+    def __init__(self, tunnel, backend, check):
+        self.tunnel = tunnel
+        self.backend = backend
+        self.check = check
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+
+    def _avoid(self, active):
+        return [t.config.name for t in active if t.config is not None]
+
+    def build(self, active=()):
+        """Start the standby tunnel in the background."""
+        def _build():
+            self.tunnel.start(self._avoid(active))
+            print("Standby ready on port {}.".format(self.tunnel.local_port))
+            self._ready.set()
+        threading.Thread(target=_build, daemon=True).start()
+
+    def _rebuild(self, tunnel, backend, active, balancer):
+        def _rebuild():
+            # let the connections already on it finish first
+            balancer.drain(backend, DRAIN_TIMEOUT)
+            tunnel.restart(self._avoid(active))
+            backend.draining = False
+            print("Standby ready on port {}.".format(tunnel.local_port))
+            self._ready.set()
+        threading.Thread(target=_rebuild, daemon=True).start()
+
+    def _healthy(self):
+        standby = self.tunnel
+        if not test_tunnel(standby.ssh_tunnel, standby.config):
+            return False
+        result = probe_tunnel(self.check, standby.local_port)
+        return result is not None and result.rtt <= self.check.getfloat(
+                'max_rtt')
+
+    def _check(self, active, balancer):
+        """Rebuild the standby if it fails check, self._lock held.
+
+        Returns True if it is usable.
+        """
+        if not self._ready.is_set():
+            return False
+        if self._healthy():
+            return True
+        print_err("Standby on port {} failed the check, rebuilding...".format(
+            self.tunnel.local_port))
+        self._ready.clear()
+        self._rebuild(self.tunnel, self.backend, active, balancer)
+        return False
+
+    def start_checking(self, active, balancer, interval):
+        """Check the idle standby every interval."""
+        def _loop():
+            while True:
+                sleep(interval)
+                with self._lock:
+                    self._check(active, balancer)
+        threading.Thread(target=_loop, daemon=True).start()
+
+    def take_over(self, tunnel, backend, active, balancer):
+        """Promote the standby in place of tunnel.
+
+        active is the list of tunnels in use, and is updated. Returns the
+        (tunnel, backend) to use from now on, or None if the standby is not
+        usable.
+        """
+        with self._lock:
+            if not self._check(active, balancer):
+                return None
+            standby, standby_backend = self.tunnel, self.backend
+            standby_backend.rtt = None
+            standby_backend.draining = False
+            standby_backend.healthy = True
+            backend.healthy = False
+            self.tunnel, self.backend = tunnel, backend
+            self._ready.clear()
+            active[active.index(tunnel)] = standby
+        print("Switched to standby on port {}.".format(standby.local_port))
+        # the degraded tunnel becomes the new standby
+        self._rebuild(tunnel, backend, active, balancer)
+        return standby, standby_backend
+
+def _format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}h{:02d}m{:02d}s'.format(hours, minutes, seconds)
+
+def report_status(tunnels, metrics_file=None, standby=None):
+    """Update the metrics file and the systemd status line."""
+    tunnels = [t for t in tunnels if t.ready_at is not None]
+    spare = standby.tunnel if standby is not None else None
+    for tunnel in tunnels:
+        UPTIME.set(round(tunnel.uptime()), port=tunnel.local_port)
+    if metrics_file is not None:
+        METRICS.write(metrics_file)
+    if LINUX and tunnels:
+        rtt_p50 = CHECK_RTT.quantile(0.5)
+        rtt_p95 = CHECK_RTT.quantile(0.95)
+        status = "{} up {}, rtt p50 {} p95 {}, {} restarts, {} failed checks"
+        status = status.format(
+            ', '.join(t.config.name + (' (standby)' if t is spare else '')
+                for t in tunnels),
+            _format_duration(min((t.uptime() for t in tunnels
+                if t is not spare), default=0)),
+            '-' if rtt_p50 is None else '<{:.0f}ms'.format(rtt_p50 * 1000),
+            '-' if rtt_p95 is None else '<{:.0f}ms'.format(rtt_p95 * 1000),
+            RESTARTS.total(), CHECKS.get(result='failed'))
+        systemd.daemon.notify('STATUS=' + status)
+
+def start_reporting(tunnels, interval, metrics_file=None, standby=None):
+    def _loop():
+        while True:
+            sleep(interval)
+            report_status(tunnels, metrics_file, standby)
+    threading.Thread(target=_loop, daemon=True).start()
+
+def monitor(tunnel, check, interval, max_bad, balancer=None, backend=None,
+        standby=None, active=()):
+    """Check the tunnel forever, and restart it when it degrades.
+
+    With a standby, the degraded tunnel is replaced by it instead.
+    active is the shared list of tunnels in use, which the standby should
+    not share a vps with.
+    """
+    max_rtt = check.getfloat('max_rtt')
     bad_count = 0
+    slow_count = 0
     while True:
-        sleep(6)
-        good = test_tunnel(ssh_tunnel, config)
-        if not good:
+        sleep(interval)
+        good = test_tunnel(tunnel.ssh_tunnel, tunnel.config)
+        result = probe_tunnel(check, tunnel.local_port) if good else None
+        if result is None:
             bad_count += 1
+            slow_count = 0
+            CHECKS.inc(result='failed')
             print_err("Tunnel timed out. [count = {}]".format(bad_count))
-            if bad_count > 2:
-                print_err("Tunnel unresponsive, shutting down tunnel...")
-                shutdown_tunnel(ssh_tunnel)
-                ssh_tunnel = start_tunnel(config)
+        elif result.rtt > max_rtt:
+            bad_count = 0
+            slow_count += 1
+            CHECKS.inc(result='slow')
+            print_err("Tunnel slow: {}. [count = {}]".format(result,
+                slow_count))
         else:
             bad_count = 0
+            slow_count = 0
+            CHECKS.inc(result='ok')
+        if result is not None:
+            CHECK_RTT.observe(result.rtt)
+        if backend is not None:
+            backend.rtt = result.rtt if result is not None else None
+            backend.healthy = result is not None
+
+        if bad_count >= max_bad or slow_count >= MAX_SLOW_COUNT:
+            RESTARTS.inc(reason='failed' if bad_count else 'slow')
+            bad_count = 0
+            slow_count = 0
+            taken = None
+            if standby is not None:
+                taken = standby.take_over(tunnel, backend, active, balancer)
+            if taken is not None:
+                tunnel, backend = taken
+                continue
+            print_err("Tunnel unresponsive, shutting down tunnel...")
+            if balancer is not None:
+                print_err("Draining backend on port {}...".format(
+                    backend.port))
+                balancer.drain(backend, DRAIN_TIMEOUT)
+                backend.healthy = False
+            tunnel.restart()
+            if backend is not None:
+                backend.draining = False
+                backend.healthy = True
+            bad_count = 0
+            slow_count = 0
+
+def _parse_args():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description="")
+    parser.add_argument('-p', '--pool', action='store_true',
+            help="use the fastest of all configured vps")
+    parser.add_argument('-b', '--backends', type=int, default=1,
+            help="number of tunnels to spread the connections over")
+    parser.add_argument('-s', '--strategy', default='least-conn',
+            choices=['least-conn', 'latency'],
+            help="how to choose the tunnel of a new connection")
+    parser.add_argument('--standby', action='store_true',
+            help="keep a spare tunnel to switch to at once")
+    parser.add_argument('--metrics-file',
+            help="write metrics to this file after every check")
+    parser.add_argument('--metrics-port', type=int,
+            help="serve metrics over http on this port of localhost")
+    args = parser.parse_args()
+    return args
+
+def run():
+    args = _parse_args()
+    check = read_check_config()
+    pool = None
+    config = None
+    if args.pool:
+        pool = VPSPool(read_pool_config())
+        interval, max_bad = POOL_CHECK_INTERVAL, POOL_MAX_BAD_COUNT
+    else:
+        config = read_config()
+        interval, max_bad = CHECK_INTERVAL, MAX_BAD_COUNT
+    if args.metrics_port is not None:
+        METRICS.serve(args.metrics_port)
+
+    if args.backends <= 1 and not args.standby:
+        tunnel = Tunnel(LOCAL_PORT, config, pool)
+        tunnel.start()
+        if pool is not None:
+            pool.start_ranking()
+        if LINUX:
+            systemd.daemon.notify('READY=1')
+        start_reporting([tunnel], interval, args.metrics_file)
+        monitor(tunnel, check, interval, max_bad)
+        return
+
+    n_backends = max(args.backends, 1)
+    ports = [BACKEND_PORT + i for i in range(n_backends)]
+    tunnels = [Tunnel(port, config, pool) for port in ports]
+    backends = [Backend(port) for port in ports]
+    all_tunnels = list(tunnels)
+    standby = None
+    if args.standby:
+        standby_port = BACKEND_PORT + n_backends
+        standby_tunnel = Tunnel(standby_port, config, pool)
+        standby_backend = Backend(standby_port)
+        standby = Standby(standby_tunnel, standby_backend, check)
+        all_tunnels.append(standby_tunnel)
+    balancer = SocksBalancer(LOCAL_PORT,
+            backends + ([standby.backend] if standby else []), args.strategy)
+    balancer.start()
+    print("Front-end listening on port {}.".format(LOCAL_PORT))
+    for tunnel, backend in zip(tunnels, backends):
+        tunnel.start()
+        backend.healthy = True
+        if LINUX and tunnel is tunnels[0]:
+            systemd.daemon.notify('READY=1')
+    active = list(tunnels)
+    if standby is not None:
+        standby.build(active)
+        standby.start_checking(active, balancer, interval)
+    if pool is not None:
+        pool.start_ranking()
+    start_reporting(all_tunnels, interval, args.metrics_file, standby)
 
+    threads = [threading.Thread(target=monitor, daemon=True,
+            args=(tunnel, check, interval, max_bad, balancer, backend,
+                standby, active))
+            for tunnel, backend in zip(tunnels, backends)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
 
 if __name__ == '__main__':
     run()
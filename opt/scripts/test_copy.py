@@ -0,0 +1,46 @@
+"""Tests of _copy, run with `python3 -m unittest test_copy`."""
+import os
+import shutil
+import tempfile
+import unittest
+
+from _copy import Copier
+
+
+class SyncTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.dir, 'src')
+        self.dst = os.path.join(self.dir, 'dst')
+        self.manifest = os.path.join(self.dir, 'manifest.json')
+        os.mkdir(self.src)
+        with open(os.path.join(self.src, 'file'), 'w') as f:
+            f.write('content')
+        os.symlink('file', os.path.join(self.src, 'link'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _sync(self):
+        with Copier(manifest=self.manifest) as copier:
+            copier.copytree(self.src, self.dst)
+        return copier.stats
+
+    def test_removed_symlink_is_pruned(self):
+        self._sync()
+        self.assertEqual(os.readlink(os.path.join(self.dst, 'link')), 'file')
+        os.unlink(os.path.join(self.src, 'link'))
+        stats = self._sync()
+        self.assertFalse(os.path.lexists(os.path.join(self.dst, 'link')))
+        self.assertTrue(os.path.exists(os.path.join(self.dst, 'file')))
+        self.assertEqual(stats.removed, 1)
+
+    def test_unchanged_symlink_is_kept(self):
+        self._sync()
+        stats = self._sync()
+        self.assertEqual(os.readlink(os.path.join(self.dst, 'link')), 'file')
+        self.assertEqual(stats.unchanged, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,31 @@
 #!/usr/bin/env python3
 """Update /etc/goagent with new ips.
+
+The ips are read from stdin or NEW_IP_FILE, or found with --scan: the
+given candidates (ips, CIDR ranges, or files of them) are probed
+concurrently, and the ones with the fastest TLS handshake are used.
+Scan results are cached in SCAN_CACHE_FILE, so a repeated scan only
+probes the ips whose result is older than --ttl.
 """
-import fileinput
 import re
 import shutil
 import sys
+import os
 import select
+import ssl
+import json
+import asyncio
+import ipaddress
+from time import monotonic, time
+
+from _utils import write_file
 
 NEW_IP_FILE = '/home/statistician/opt/search_google_ip/good_ips'
 GOAGENT_CONFIG_FILE = '/etc/goagent'
+SCAN_CACHE_FILE = '/var/cache/update_goagent_ip/scan.json'
+
+SCAN_PORT = 443
+SCAN_SNI = 'www.google.com'
 
 
 def load_ips_from_file():
@@ -17,25 +34,135 @@ def load_ips_from_file():
     return ips
 
 def replace_old_ips(new_ips):
-    for line in fileinput.input(files=GOAGENT_CONFIG_FILE, inplace=True, backup='.bak'):
-        line = line.rstrip()
-        if re.search(r'google_cn|google_hk|google_talk', line):
-            line = re.sub(r'= ?.*$', '= ' + new_ips, line)
-        print(line)
+    lines = []
+    with open(GOAGENT_CONFIG_FILE) as f:
+        for line in f:
+            line = line.rstrip()
+            if re.search(r'google_cn|google_hk|google_talk', line):
+                line = re.sub(r'= ?.*$', '= ' + new_ips, line)
+            lines.append(line + '\n')
+    write_file(GOAGENT_CONFIG_FILE, ''.join(lines), backup=True)
+
+def expand_candidates(candidates):
+    """Turn ips, CIDR ranges and files of them into a list of ips."""
+    ips = []
+    for candidate in candidates:
+        if os.path.isfile(candidate):
+            with open(candidate) as f:
+                words = re.split(r'[\s|,]+', f.read())
+            ips.extend(expand_candidates([w for w in words if w]))
+        elif '/' in candidate:
+            ips.extend(str(ip) for ip in
+                    ipaddress.ip_network(candidate, strict=False).hosts())
+        else:
+            ips.append(str(ipaddress.ip_address(candidate)))
+    return list(dict.fromkeys(ips))
+
+def load_scan_cache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_scan_cache(path, cache):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_file(path, json.dumps(cache), sync=False)
+
+async def probe_ip(ip, port, ssl_ctx, sni, timeout):
+    """Returns (connect time, handshake time), or None on failure."""
+    try:
+        start = monotonic()
+        reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(ip, port), timeout)
+        connected = monotonic()
+        try:
+            await asyncio.wait_for(writer.start_tls(ssl_ctx,
+                server_hostname=sni), timeout)
+            handshake = monotonic() - connected
+        finally:
+            writer.close()
+        return connected - start, handshake
+    except (OSError, asyncio.TimeoutError, ssl.SSLError):
+        return None
+
+async def scan(ips, cache, ttl, parallel=64, timeout=2.0, port=SCAN_PORT,
+        sni=SCAN_SNI, verify=True):
+    """Probe the ips not fresh in cache, updating it in place."""
+    ssl_ctx = ssl.create_default_context()
+    if not verify:
+        ssl_ctx.check_hostname = False
+        ssl_ctx.verify_mode = ssl.CERT_NONE
+    sem = asyncio.Semaphore(parallel)
+    now = time()
+
+    async def _probe(ip):
+        async with sem:
+            result = await probe_ip(ip, port, ssl_ctx, sni, timeout)
+        cache[ip] = {'time': now, 'result': result}
+
+    stale = [ip for ip in ips
+            if ip not in cache or now - cache[ip]['time'] > ttl]
+    print("Scanning {} ips ({} cached)...".format(len(stale),
+        len(ips) - len(stale)))
+    await asyncio.gather(*(_probe(ip) for ip in stale))
+
+def fastest_ips(ips, cache, top):
+    good = [ip for ip in ips if cache.get(ip, {}).get('result')]
+    good.sort(key=lambda ip: sum(cache[ip]['result']))
+    return good[:top]
+
+def scan_ips(args):
+    ips = expand_candidates(args.scan)
+    cache = load_scan_cache(args.cache)
+    asyncio.run(scan(ips, cache, args.ttl, args.parallel, args.timeout,
+        sni=args.sni, verify=not args.insecure))
+    save_scan_cache(args.cache, cache)
+    best = fastest_ips(ips, cache, args.top)
+    for ip in best:
+        connect, handshake = cache[ip]['result']
+        print("\t{}: connect {:.0f} ms, handshake {:.0f} ms".format(
+            ip, connect * 1000, handshake * 1000))
+    if not best:
+        sys.exit("No working ip found.")
+    return '|'.join(best)
+
+def _parse_args():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description="")
+    parser.add_argument('-s', '--scan', nargs='+', metavar='CANDIDATE',
+            help="ips, CIDR ranges or files of them to scan")
+    parser.add_argument('-n', '--top', type=int, default=10,
+            help="number of ips to use")
+    parser.add_argument('-p', '--parallel', type=int, default=64,
+            help="max number of ips probed at the same time")
+    parser.add_argument('-t', '--timeout', type=float, default=2.0,
+            help="timeout of each step of a probe, in seconds")
+    parser.add_argument('--ttl', type=float, default=3600,
+            help="seconds a cached result stays valid")
+    parser.add_argument('--cache', default=SCAN_CACHE_FILE)
+    parser.add_argument('--sni', default=SCAN_SNI,
+            help="server name sent in the TLS handshake")
+    parser.add_argument('--insecure', action='store_true',
+            help="do not verify the certificates")
+    args = parser.parse_args()
+    return args
 
 def run():
-    from_stdin = select.select([sys.stdin], [], [], 0)[0]
-    if from_stdin:
-        new_ips = sys.stdin.readline().rstrip()
+    args = _parse_args()
+    if args.scan:
+        new_ips = scan_ips(args)
+        source = "scan"
     else:
-        new_ips = load_ips_from_file()
+        from_stdin = select.select([sys.stdin], [], [], 0)[0]
+        if from_stdin:
+            new_ips = sys.stdin.readline().rstrip()
+        else:
+            new_ips = load_ips_from_file()
+        source = "stdin" if from_stdin else NEW_IP_FILE
     replace_old_ips(new_ips)
     shutil.chown(GOAGENT_CONFIG_FILE, group='nobody')
-    print("{} updated from {}.".format(
-        GOAGENT_CONFIG_FILE,
-        "stdin" if from_stdin else NEW_IP_FILE
-    ))
+    print("{} updated from {}.".format(GOAGENT_CONFIG_FILE, source))
 
 if __name__ == "__main__":
     run()
-